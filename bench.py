@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+"""Micro benchmarks for the erlastic codec.
+
+Run all benchmarks with ``python bench.py`` or a selection of them by name,
+e.g. ``python bench.py encode_wide encode_deep``. ``--save FILE`` saves the
+times measured as a baseline, which ``--compare FILE`` compares them to,
+exiting with status 1 if any benchmark got slower by more than
+``--tolerance`` (10% by default).
+"""
+
+import argparse
+import array
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+from erlastic import DecodeLimits, ErlangTermDecoder, ErlangTermEncoder, TermStreamDecoder
+from erlastic.compression import CompressionPolicy
+from erlastic.files import TermFileReader, TermFileWriter
+from erlastic.instrument import instrument
+from erlastic.tcp import TermClient, TermServer, call
+from erlastic.types import *
+
+def wide_term():
+    return tuple((Atom("item"), i, b"payload", 1.5) for i in range(10000))
+
+def deep_term():
+    term = []
+    for i in range(200):
+        term = [(Atom("node"), i, term)]
+    return term
+
+def timed(func, number=20, repeat=5):
+    """Return the best time per call of func in seconds, calling it number
+    times per repeat, or enough times to take 0.2 s if number is None"""
+    if number is None:
+        number = timeit.Timer(func).autorange()[0]
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+# Seconds per call, by benchmark name
+results = {}
+
+def report(name, seconds, size=None):
+    results[name] = seconds
+    line = "%-24s %10.3f ms/op %10.0f ops/s" % (name, seconds * 1000, 1 / seconds)
+    if size is not None:
+        line += " %10.1f MB/s" % (size / seconds / 1e6)
+    print(line)
+
+def bench_encode_wide():
+    encoder = ErlangTermEncoder()
+    term = wide_term()
+    size = len(encoder.encode(term))
+    report("encode_wide", timed(lambda: encoder.encode(term)), size)
+
+def bench_encode_deep():
+    encoder = ErlangTermEncoder()
+    term = deep_term()
+    size = len(encoder.encode(term))
+    report("encode_deep", timed(lambda: encoder.encode(term), number=200), size)
+
+def bench_encode_into():
+    encoder = ErlangTermEncoder()
+    term = wide_term()
+    buf = bytearray()
+    size = encoder.encode_into(term, buf)
+    report("encode_into", timed(lambda: encoder.encode_into(term, buf)), size)
+
+def bench_encode_cached():
+    term = [(Atom("ok"), (Atom("state"), Atom("running"), i % 4)) for i in range(10000)]
+    for name, encoder in [("uncached", ErlangTermEncoder()), ("cached", ErlangTermEncoder(cache=True))]:
+        size = len(encoder.encode(term))
+        report("encode_" + name, timed(lambda: encoder.encode(term)), size)
+
+def bench_profiles():
+    count = 10000
+    node = "worker@host"
+    # Times are those of the whole list of count terms
+    term = [(Atom("sample"), PID(node, i, 0, 1), i / 3.0, Atom("ok"), 2**70 + i) for i in range(count)]
+    for profile in ("legacy", "modern"):
+        encoder = ErlangTermEncoder(profile=profile)
+        decoder = ErlangTermDecoder()
+        buf = encoder.encode(term)
+        print("%-24s %10.1f bytes/term" % ("size_" + profile, len(buf) / count))
+        report("encode_" + profile, timed(lambda: encoder.encode(term), number=5), len(buf))
+        report("decode_" + profile, timed(lambda: decoder.decode(buf), number=5), len(buf))
+
+def bench_atoms():
+    term = [(Atom("event"), Atom("node_%d" % (i % 300)), Atom("ok")) for i in range(10000)]
+    for name, cache in [("uncached", None), ("cached", True)]:
+        encoder = ErlangTermEncoder(atom_cache=cache)
+        decoder = ErlangTermDecoder(atom_cache=cache)
+        buf = encoder.encode(term)
+        report("encode_atoms_" + name, timed(lambda: encoder.encode(term)), len(buf))
+        report("decode_atoms_" + name, timed(lambda: decoder.decode(buf)), len(buf))
+
+def bench_decode_wide():
+    encoder, decoder = ErlangTermEncoder(), ErlangTermDecoder()
+    buf = encoder.encode(wide_term())
+    report("decode_wide", timed(lambda: decoder.decode(buf)), len(buf))
+
+def bench_decode_flat():
+    encoder, decoder = ErlangTermEncoder(), ErlangTermDecoder()
+    buf = encoder.encode(list(range(100000)))
+    report("decode_flat", timed(lambda: decoder.decode(buf)), len(buf))
+
+def bench_decode_deep():
+    decoder = ErlangTermDecoder()
+    depth = 10000
+    buf = b"\x83" + b"l\x00\x00\x00\x01" * depth + b"j" * (depth + 1)
+    report("decode_deep", timed(lambda: decoder.decode(buf)), len(buf))
+
+def bench_maps():
+    fields = [Atom("field_%d" % i) for i in range(10)]
+    records = [dict((field, i) for field in fields) for i in range(5000)]
+    binary_records = [dict((field.encode(), i) for field in fields) for i in range(5000)]
+    proplists = [list(record.items()) for record in records]
+    for name, encoder, term in [("map", ErlangTermEncoder(), records),
+                                ("map_sorted", ErlangTermEncoder(sort_map_keys=True), records),
+                                ("map_binary_keys", ErlangTermEncoder(), binary_records),
+                                ("proplist", ErlangTermEncoder(), proplists)]:
+        decoder = ErlangTermDecoder()
+        buf = encoder.encode(term)
+        report("encode_" + name, timed(lambda: encoder.encode(term), number=5), len(buf))
+        report("decode_" + name, timed(lambda: decoder.decode(buf), number=5), len(buf))
+    # The proplist workaround, converted to dicts on both ends
+    encoder, decoder = ErlangTermEncoder(), ErlangTermDecoder()
+    buf = encoder.encode(proplists)
+    report("encode_proplist_dicts", timed(lambda: encoder.encode([list(record.items()) for record in records]), number=5), len(buf))
+    report("decode_proplist_dicts", timed(lambda: [dict(items) for items in decoder.decode(buf)], number=5), len(buf))
+
+class Order(object):
+    __slots__ = ('id', 'customer', 'status', 'amount', 'note')
+    __annotations__ = {'id': int, 'customer': bytes, 'status': Atom, 'amount': float, 'note': str}
+
+def bench_records():
+    orders = []
+    for i in range(10000):
+        order = Order.__new__(Order)
+        order.id, order.customer, order.status, order.amount, order.note = i, b"acme", Atom("open"), i / 4.0, "rush"
+        orders.append(order)
+    tuples = [(Atom("order"), o.id, o.customer, o.status, o.amount, o.note) for o in orders]
+    plain_encoder, plain_decoder = ErlangTermEncoder(profile="modern"), ErlangTermDecoder()
+    buf = plain_encoder.encode(tuples)
+    def unpack(term):
+        result = []
+        for _, id, customer, status, amount, note in term:
+            order = Order.__new__(Order)
+            order.id, order.customer, order.status, order.amount, order.note = id, customer, status, amount, note.decode()
+            result.append(order)
+        return result
+    report("encode_record_tuples", timed(lambda: plain_encoder.encode(
+        [(Atom("order"), o.id, o.customer, o.status, o.amount, o.note) for o in orders]), number=5), len(buf))
+    report("decode_record_tuples", timed(lambda: unpack(plain_decoder.decode(buf)), number=5), len(buf))
+    encoder, decoder = ErlangTermEncoder(profile="modern"), ErlangTermDecoder()
+    encoder.register_record("order", Order)
+    decoder.register_record("order", Order)
+    report("encode_records", timed(lambda: encoder.encode(orders), number=5), len(buf))
+    report("decode_records", timed(lambda: decoder.decode(buf), number=5), len(buf))
+
+def bench_limits():
+    encoder = ErlangTermEncoder()
+    terms = [("wide", wide_term()), ("maps", [{Atom("id"): i, Atom("tags"): [Atom("a"), b"b"]} for i in range(10000)]),
+             ("compressed", [b"payload" * 100] * 1000)]
+    for name, decoder in [("unlimited", ErlangTermDecoder()),
+                          ("limited", ErlangTermDecoder(limits=DecodeLimits()))]:
+        for term_name, term in terms:
+            buf = encoder.encode(term, compressed=term_name == "compressed")
+            report("decode_%s_%s" % (term_name, name), timed(lambda: decoder.decode(buf)), len(buf))
+
+def corpus():
+    """Representative terms, by name. The compressed one is meant to be
+    encoded with compressed=True."""
+    return {
+        "wide_tuple": wide_term(),
+        "deep_list": deep_term(),
+        "big_binary": (Atom("blob"), bytes(random_bytes(1 << 20))),
+        "atom_records": [(Atom("user"), i, Atom("active"), Atom("admin"), Atom("zone_%d" % (i % 4)))
+                         for i in range(10000)],
+        "bigints": [(2**200 + i) * (-1)**i for i in range(10000)],
+        "floats": [(i / 7.0, i * -1.5) for i in range(10000)],
+        "compressed": (Atom("text"), b" ".join(b"word%d" % (i % 500) for i in range(50000))),
+    }
+
+def bench_corpus():
+    encoder, decoder = ErlangTermEncoder(), ErlangTermDecoder()
+    for name, term in sorted(corpus().items()):
+        compressed = name == "compressed"
+        buf = encoder.encode(term, compressed=compressed)
+        for action, func in [("encode", lambda: encoder.encode(term, compressed=compressed)),
+                             ("decode", lambda: decoder.decode(buf))]:
+            peak = peak_allocated(func)
+            report("%s_%s" % (action, name), timed(func, number=None, repeat=3), len(buf))
+            print("%-24s %10.3f MB peak" % ("%s_%s" % (action, name), peak / 1e6))
+
+def bench_instrument():
+    terms = corpus()
+    del terms["compressed"]
+    encoder, decoder = ErlangTermEncoder(), ErlangTermDecoder()
+    bufs = [encoder.encode(term) for term in terms.values()]
+    size = sum(len(buf) for buf in bufs)
+    report("decode_corpus", timed(lambda: [decoder.decode(buf) for buf in bufs], number=3, repeat=3), size)
+    stats = instrument(decoder)
+    report("decode_instrumented", timed(lambda: [decoder.decode(buf) for buf in bufs], number=3, repeat=3), size)
+    print(stats.report())
+
+def bench_compression():
+    # A mix of small messages, compressible payloads and random bytes
+    # standing for already compressed ones
+    random = bytes(random_bytes(50000))
+    terms = ([(Atom("ping"), i) for i in range(200)] + [wide_term()[:500]] * 10
+             + [(Atom("blob"), random[i:i+20000]) for i in range(0, 30000, 3000)])
+    size = sum(len(ErlangTermEncoder().encode(term)) for term in terms)
+    for name, compressed in [("none", False), ("level_6", 6), ("policy", CompressionPolicy())]:
+        encoder = ErlangTermEncoder()
+        seconds = timed(lambda: [encoder.encode(term, compressed=compressed) for term in terms], number=3)
+        out = sum(len(encoder.encode(term, compressed=compressed)) for term in terms)
+        report("compress_" + name, seconds, size)
+        print("%-24s %10.1f %% of the size" % ("compress_" + name, 100.0 * out / size))
+
+def random_bytes(n, seed=1):
+    """Deterministic incompressible bytes"""
+    state = seed
+    for i in range(n):
+        state = (state * 1103515245 + 12345) & 0x7fffffff
+        yield state >> 16 & 0xff
+
+def bench_numeric():
+    count = 1000000
+    encoder = ErlangTermEncoder()
+    ints = [i * 7 - 3000000 for i in range(count)]
+    floats = [i / 7.0 for i in range(count)]
+    for name, values, typecode in [("ints", ints, 'i'), ("floats", floats, 'd')]:
+        packed = array.array(typecode, values)
+        buf = encoder.encode(packed)
+        report("encode_%s_list" % name, timed(lambda: encoder.encode(values), number=1, repeat=3), len(buf))
+        report("encode_%s_array" % name, timed(lambda: encoder.encode(packed), number=1, repeat=3), len(buf))
+        for mode in (None, "array"):
+            decoder = ErlangTermDecoder(numeric_lists=mode)
+            report("decode_%s_%s" % (name, mode or "list"), timed(lambda: decoder.decode(buf), number=1, repeat=3), len(buf))
+        # The same list with the elements alternating between two tags
+        mixed = encoder.encode([values[0]] + [1, values[0]] * (count // 2))
+        report("decode_%s_mixed" % name, timed(lambda: decoder.decode(mixed), number=1, repeat=3), len(mixed))
+
+def bench_stream_feed():
+    encoder = ErlangTermEncoder()
+    term = encoder.encode((Atom("event"), list(range(50)), b"x" * 1000))
+    data = (struct.pack(">L", len(term)) + term) * 1000
+    for packet, data in [(4, data), (0, term * 1000)]:
+        def feed():
+            stream = TermStreamDecoder(packet=packet)
+            for i in range(0, len(data), 65536):
+                stream.feed(data[i:i+65536])
+        report("stream_feed_packet_%d" % packet, timed(feed, number=5), len(data))
+
+def bench_route():
+    encoder, decoder = ErlangTermEncoder(), ErlangTermDecoder()
+    buf = encoder.encode((Atom("event"), [1, 2], wide_term()))
+    report("route_decode", timed(lambda: decoder.decode(buf)[0]), len(buf))
+    report("route_extract", timed(lambda: decoder.extract(buf, (0,)), number=1000), len(buf))
+
+def peak_allocated(func):
+    """Return the peak number of bytes allocated while running func"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_decode_big_binary():
+    buf = bytearray(ErlangTermEncoder().encode((Atom("blob"), b"x" * (50 << 20))))
+    for name, decoder in [("copy", ErlangTermDecoder()),
+                          ("borrow", ErlangTermDecoder(borrow_binaries=True))]:
+        peak = peak_allocated(lambda: decoder.decode(buf))
+        name = "decode_big_binary_" + name
+        report(name, timed(lambda: decoder.decode(buf), number=5, repeat=3), len(buf))
+        print("%-24s %10.1f MB peak" % (name, peak / 1e6))
+
+def bench_dump():
+    encoder = ErlangTermEncoder()
+    term = [(Atom("row"), i, b"payload" * 10, "text") for i in range(200000)]
+    sink = NullFile()
+    size = len(encoder.encode(term))
+    for name, func, kwargs in [("encode", lambda: sink.write(encoder.encode(term)), {}),
+                               ("dump", lambda: encoder.dump(term, sink), {"number": 3}),
+                               ("dump_compressed", lambda: encoder.dump(term, sink, compressed=True), {"number": 1})]:
+        peak = peak_allocated(func)
+        report(name, timed(func, repeat=3, **kwargs), size)
+        print("%-24s %10.1f MB peak" % (name, peak / 1e6))
+
+class NullFile(object):
+    def write(self, data):
+        return len(data)
+
+def bench_identifiers():
+    count = 100000
+    encoder, decoder = ErlangTermEncoder(), ErlangTermDecoder()
+    buf = encoder.encode([PID("node_%d@host" % (i % 10), i % 200, 0, 1) for i in range(count)])
+    pids = []
+    peak = peak_allocated(lambda: pids.extend(decoder.decode(buf)))
+    print("%-24s %10.1f bytes/pid" % ("decoded_pid_memory", peak / count - 8))
+    table = dict((pid, i) for i, pid in enumerate(pids))
+    report("pid_lookup", timed(lambda: [table[pid] for pid in pids], number=3) / count)
+
+def event_size(event):
+    return len(event[2])
+
+def bench_term_file():
+    count = 200000
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "events.etf")
+        events = [(Atom("event"), i, b"payload" * 10, [1.5, i]) for i in range(count)]
+        def write():
+            with TermFileWriter(path) as writer:
+                writer.extend(events)
+            os.remove(path)
+        report("term_file_write", timed(write, number=1, repeat=3) / count)
+        with TermFileWriter(path) as writer:
+            writer.extend(events)
+        size = os.path.getsize(path)
+        def index():
+            os.remove(path + ".idx")
+            TermFileReader(path).close()
+        report("term_file_index", timed(index, number=1, repeat=3), size)
+        report("term_file_reopen", timed(lambda: TermFileReader(path).close(), number=5, repeat=3), size)
+        with TermFileReader(path) as reader:
+            positions = [random.randrange(count) for i in range(10000)]
+            report("term_file_random", timed(lambda: [reader[i] for i in positions], number=1, repeat=3) / len(positions))
+            report("term_file_scan", timed(lambda: sum(map(event_size, reader)), number=1, repeat=3), size)
+            report("term_file_map", timed(lambda: sum(reader.map(event_size, executor="process")),
+                                          number=1, repeat=3), size)
+
+def bench_tcp():
+    server = TermServer(lambda request: request)
+    server.start()
+    request = (Atom("get"), 42, b"key")
+    size = len(ErlangTermEncoder().encode(request))
+    batch = [request] * 100
+    payload = (Atom("put"), b"x" * 65536)
+    try:
+        with TermClient(server.address) as client:
+            report("tcp_per_request", timed(lambda: call(server.address, request), number=200, repeat=3), size)
+            report("tcp_pooled", timed(lambda: client.call(request), number=1000, repeat=3), size)
+            report("tcp_pipelined", timed(lambda: client.call_many(batch), number=20, repeat=3) / len(batch), size)
+            report("tcp_pooled_64k", timed(lambda: client.call(payload), number=200, repeat=3), 65536)
+    finally:
+        server.close()
+
+def compare(baseline, tolerance):
+    """Print the change of every benchmark also in baseline and return the
+    number of those slower by more than tolerance"""
+    regressions = 0
+    for name, seconds in sorted(results.items()):
+        if name not in baseline:
+            continue
+        change = seconds / baseline[name] - 1
+        flag = ""
+        if change > tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("%-24s %10.3f -> %10.3f ms/op %+7.1f %%%s" % (name, baseline[name] * 1000, seconds * 1000, change * 100, flag))
+    return regressions
+
+def main(argv):
+    benchmarks = dict((k[6:], v) for k, v in globals().items() if k.startswith("bench_"))
+    parser = argparse.ArgumentParser(description="Benchmark the erlastic codec")
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help="benchmarks to run, all by default: %s" % ", ".join(sorted(benchmarks)))
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results to a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown over which a benchmark counts as a regression")
+    args = parser.parse_args(argv)
+    unknown = set(args.names) - set(benchmarks)
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+    for name in args.names or sorted(benchmarks):
+        benchmarks[name]()
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        return 1 if compare(baseline, args.tolerance) else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
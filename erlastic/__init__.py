@@ -4,26 +4,33 @@
 __version__ = "2.0.0"
 __license__ = "BSD"
 
-from erlastic.codec import ErlangTermDecoder, ErlangTermEncoder
+from erlastic.codec import ErlangTermDecoder, ErlangTermEncoder, LazyTerm, DecodeLimits
+from erlastic.stream import TermStreamDecoder
 from erlastic.types import *
 
-encode = ErlangTermEncoder().encode
+_encoder = ErlangTermEncoder()
+encode = _encoder.encode
+iterencode = _encoder.iterencode
+dump = _encoder.dump
 decode = ErlangTermDecoder().decode
 
 import struct
 import sys
-def mailbox_gen():
+def mailbox_gen(chunk_size=65536, raw=False):
+  stream = TermStreamDecoder(packet=4)
+  feed = stream.feed_frames if raw else stream.feed
   while True:
-    len_bin = sys.stdin.buffer.read(4)
-    if len(len_bin) != 4: return None
-    (length,) = struct.unpack('!I',len_bin)
-    yield decode(sys.stdin.buffer.read(length))
-def port_gen():
+    data = sys.stdin.buffer.read1(chunk_size)
+    if not data: return None
+    for term in feed(data):
+      yield term
+def port_gen(raw=False):
   while True:
-    term = encode((yield))
-    sys.stdout.buffer.write(struct.pack('!I',len(term)))
-    sys.stdout.buffer.write(term)
-def port_connection():
-  port = port_gen()
+    term = yield
+    if not raw: term = encode(term)
+    sys.stdout.buffer.write(struct.pack('!I',len(term)) + term)
+    sys.stdout.buffer.flush()
+def port_connection(raw=False):
+  port = port_gen(raw)
   next(port)
-  return mailbox_gen(),port
+  return mailbox_gen(raw=raw),port
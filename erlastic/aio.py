@@ -0,0 +1,82 @@
+"""asyncio transport for exchanging terms with Erlang"""
+
+import asyncio
+import collections
+import sys
+
+from erlastic.codec import ErlangTermEncoder, EncodingError
+from erlastic.stream import TermStreamDecoder, encode_frame
+
+__all__ = ["AsyncPortConnection", "port_connection"]
+
+class AsyncPortConnection(object):
+    """Exchange terms over a pair of asyncio streams.
+
+    Iterate over the connection with ``async for`` to receive terms and
+    await send() to send one. Frames sent during the same iteration of the
+    event loop are written with a single call, after which every sender
+    waits for the writer to drain.
+    """
+
+    def __init__(self, reader, writer, packet=4, encoder=None, decoder=None, chunk_size=65536):
+        self.reader = reader
+        self.writer = writer
+        self.packet = packet
+        self.encoder = encoder or ErlangTermEncoder()
+        self.stream = TermStreamDecoder(packet, decoder)
+        self.chunk_size = chunk_size
+        self.received = collections.deque()
+        self.outgoing = bytearray()
+        # Resolved once the outgoing frames have been handed to the writer
+        self.flushed = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.received:
+            data = await self.reader.read(self.chunk_size)
+            if not data:
+                if len(self.stream):
+                    raise EncodingError("Stream closed in the middle of a term")
+                raise StopAsyncIteration
+            self.received.extend(self.stream.feed(data))
+        return self.received.popleft()
+
+    async def send(self, obj):
+        encode_frame(self.encoder, obj, self.outgoing, self.packet)
+        if self.flushed is None:
+            loop = asyncio.get_running_loop()
+            self.flushed = loop.create_future()
+            loop.call_soon(self.flush)
+        await asyncio.shield(self.flushed)
+        await self.writer.drain()
+
+    def flush(self):
+        flushed, self.flushed = self.flushed, None
+        data, self.outgoing = self.outgoing, bytearray()
+        try:
+            if data:
+                self.writer.write(data)
+        except Exception as e:
+            flushed.set_exception(e)
+        else:
+            flushed.set_result(None)
+
+    async def close(self):
+        if self.flushed is not None:
+            await asyncio.shield(self.flushed)
+        self.writer.close()
+        await self.writer.wait_closed()
+
+async def port_connection(packet=4, stdin=None, stdout=None, **kwargs):
+    """Return an AsyncPortConnection over stdin and stdout (or the given
+    pipes), the asyncio counterpart of erlastic.port_connection()."""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                 stdin or sys.stdin.buffer)
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin,
+                                                        stdout or sys.stdout.buffer)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return AsyncPortConnection(reader, writer, packet, **kwargs)
@@ -0,0 +1,63 @@
+"""Bounded caches used by the codec"""
+
+import collections
+
+__all__ = ["LRUCache"]
+
+class LRUCache(object):
+    """A mapping holding at most maxsize entries, which counts lookup hits
+    and misses.
+
+    Until it is full it behaves as a plain dict. From then on, entries are
+    moved to the end on every hit and the least recently used ones are
+    evicted to make room for new ones.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __setitem__(self, key, value):
+        data = self.data
+        data[key] = value
+        if len(data) > self.maxsize:
+            data.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if len(self.data) >= self.maxsize:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                # Evicted by another thread in between
+                pass
+        self.hits += 1
+        return value
+
+    def clear(self):
+        self.data.clear()
+        self.hits = self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate,
+                "size": len(self.data), "maxsize": self.maxsize}
+
+    def __repr__(self):
+        return "LRUCache(%s)" % ", ".join("%s=%r" % item for item in sorted(self.stats().items()))
@@ -1,19 +1,273 @@
 
 from __future__ import division
 
+import array
+import dataclasses
+import itertools
+import operator
 import struct
+import sys
+import typing
 import zlib
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from erlastic.cache import LRUCache
 from erlastic.constants import *
 from erlastic.types import *
 
-__all__ = ["ErlangTermEncoder", "ErlangTermDecoder", "EncodingError"]
+__all__ = ["ErlangTermEncoder", "ErlangTermDecoder", "LazyTerm", "EncodingError",
+           "DecodeLimits", "DecodeLimitError"]
 
 class EncodingError(Exception):
     pass
 
+class DecodeLimitError(EncodingError):
+    """Raised when decoding a term would exceed the DecodeLimits of the
+    decoder"""
+
+class DecodeLimits(object):
+    """Bounds on the resources a decoder may spend on a term, to decode
+    untrusted input. Any of them can be None for no limit.
+
+    max_size is the number of bytes a term may be decoded from (counted
+    from its offset to the end of the buffer, and the size of stream
+    frames), max_depth the number of containers (tuples, lists, maps) nested
+    in one another, max_length the number of elements of a container,
+    max_atoms the number of atoms in a term and max_decompressed the size of
+    a compressed term once inflated.
+    """
+
+    def __init__(self, max_size=64 << 20, max_depth=1000, max_length=1 << 24,
+                 max_atoms=1 << 20, max_decompressed=64 << 20):
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.max_length = max_length
+        self.max_atoms = max_atoms
+        self.max_decompressed = max_decompressed
+
+    def __repr__(self):
+        return "DecodeLimits(%s)" % ", ".join("%s=%r" % item for item in sorted(self.__dict__.items()))
+
+_pack_H = struct.Struct(">H").pack
+_pack_l = struct.Struct(">l").pack
+_pack_L = struct.Struct(">L").pack
+_pack_d = struct.Struct(">d").pack
+_unpack_H = struct.Struct(">H").unpack_from
+_unpack_l = struct.Struct(">l").unpack_from
+_unpack_L = struct.Struct(">L").unpack_from
+_unpack_d = struct.Struct(">d").unpack_from
+
+_SMALL_INTEGERS = [bytes([SMALL_INTEGER_EXT, i]) for i in range(256)]
+
+_MISSING = object()
+_FIELD_TYPES = frozenset([int, float, Atom, bytes, str])
+_ATOM_ENCODINGS = {ATOM_EXT: 'latin-1', SMALL_ATOM_EXT: 'latin-1',
+                   ATOM_UTF8_EXT: 'utf-8', SMALL_ATOM_UTF8_EXT: 'utf-8'}
+_first = operator.itemgetter(0)
+
+_INT_TYPECODES = frozenset("bBhHiIlLqQ")
+_ARRAY_TYPECODES = _INT_TYPECODES | frozenset("fd")
+
+# Types of the terms that don't contain others (as far as iterencode is
+# concerned): tuples only made of these are encoded in one go
+_LEAF_TYPES = frozenset([int, float, bool, type(None), Atom, str, bytes,
+                         Reference, Port, PID, Export, RawTerm])
+
+# Tags of the terms containing others, which the generated record readers
+# leave to the container stack of decode_part
+_NESTING_TAGS = frozenset([SMALL_TUPLE_EXT, LARGE_TUPLE_EXT, LIST_EXT, MAP_EXT])
+
+# Source of the generated record readers, reading a field of each type
+# into a variable. Fields that aren't in the expected form go through
+# {fallback}.
+_FIELD_READERS = {
+    None: """\
+{fallback}""",
+    int: """\
+    tag = buf[offset]
+    if tag == SMALL_INTEGER_EXT:
+        {0} = buf[offset+1]
+        offset += 2
+    elif tag == INTEGER_EXT:
+        {0} = _unpack_l(buf, offset+1)[0]
+        offset += 5
+    else:
+{fallback}""",
+    float: """\
+    if buf[offset] == NEW_FLOAT_EXT:
+        {0} = _unpack_d(buf, offset+1)[0]
+        offset += 9
+    else:
+{fallback}""",
+    Atom: """\
+    tag = buf[offset]
+    if tag == SMALL_ATOM_UTF8_EXT:
+        end = offset + 2 + buf[offset+1]
+        {0} = convert_atom(buf[offset+2:end], 'utf-8')
+        offset = end
+        atoms += 1
+    elif tag == ATOM_EXT:
+        end = offset + 3 + _unpack_H(buf, offset+1)[0]
+        {0} = convert_atom(buf[offset+3:end])
+        offset = end
+        atoms += 1
+    else:
+{fallback}""",
+    bytes: """\
+    if buf[offset] == BINARY_EXT:
+        end = offset + 5 + _unpack_L(buf, offset+1)[0]
+        {0} = convert_binary(buf[offset+5:end])
+        offset = end
+    else:
+{fallback}""",
+    str: """\
+    if buf[offset] == BINARY_EXT:
+        end = offset + 5 + _unpack_L(buf, offset+1)[0]
+        {0} = str(buf[offset+5:end], 'utf-8')
+        offset = end
+    else:
+{fallback}""",
+}
+# Reading any other term: terms that don't nest others are decoded right
+# away, the others end the reader, which returns the fields read so far for
+# decode_part to carry on on its stack
+_FIELD_FALLBACK = """\
+    tag = buf[offset]
+    if tag in _NESTING_TAGS:
+        return None, offset, [{1}], atoms
+    if tag in _ATOM_ENCODINGS:
+        atoms += 1
+    {0}, offset = decode_part(buf, offset)"""
+# Setting a field, depending on whether the class overrides __setattr__
+# (to be immutable, such as frozen dataclasses)
+_FIELD_SETTERS = {False: "    obj.{0} = {1}", True: "    setattr(obj, '{0}', {1})"}
+
+def _has_setattr(cls):
+    return cls.__setattr__ is not object.__setattr__
+
+def _compile(name, lines, **namespace):
+    """Return the function name defined by the source lines, which can
+    refer to the globals of this module and to namespace"""
+    env = dict(globals())
+    env.update(namespace)
+    exec("\n".join(lines), env)
+    return env[name]
+
+def _record_schema(cls, fields=None, types=None):
+    """Return the field names of the record class cls and their types, which
+    are None unless one of _FIELD_TYPES"""
+    if fields is None:
+        if dataclasses.is_dataclass(cls):
+            fields = [field.name for field in dataclasses.fields(cls)]
+        else:
+            fields = cls.__dict__.get('__slots__')
+            if isinstance(fields, str):
+                fields = [fields]
+        if not fields:
+            raise ValueError("%s has neither dataclass fields nor __slots__, fields must be given" % cls.__name__)
+    fields = list(fields)
+    for name in fields:
+        if not name.isidentifier():
+            raise ValueError("Invalid field name %r" % name)
+    if len(fields) > 254:
+        raise ValueError("Records have at most 254 fields")
+    if types is None:
+        try:
+            types = typing.get_type_hints(cls)
+        except Exception:
+            types = {}
+    if isinstance(types, dict):
+        types = [types.get(name) for name in fields]
+    return fields, [t if t in _FIELD_TYPES else None for t in types]
+
+def _big_endian(values, typecode):
+    """Return the values of an array.array converted to typecode as
+    big-endian bytes"""
+    if values.typecode != typecode:
+        values = array.array(typecode, values)
+    if sys.byteorder == 'little':
+        values = array.array(typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+# Size of the fixed-size numeric terms decoded in bulk, and the shortest
+# run of them (short of a whole list) worth decoding that way
+_NUMBER_RUNS = {SMALL_INTEGER_EXT: 2, INTEGER_EXT: 5, NEW_FLOAT_EXT: 9}
+_TAG_BYTES = dict((tag, bytes([tag])) for tag in _NUMBER_RUNS)
+_MIN_RUN = 16
+# Kind of the lists under construction that started with a run of numbers
+_NUMBER_LIST = -1
+_INT_TYPE = frozenset([int])
+_FLOAT_TYPE = frozenset([float])
+
+_SEQUENCE_TAGS = frozenset([SMALL_TUPLE_EXT, LARGE_TUPLE_EXT, LIST_EXT, NIL_EXT])
+
+# Size of the terms that only have fixed-width fields
+_SCALAR_SIZES = {
+    SMALL_INTEGER_EXT: 2,
+    INTEGER_EXT: 5,
+    FLOAT_EXT: 32,
+    NEW_FLOAT_EXT: 9,
+    NIL_EXT: 1,
+}
+
 class ErlangTermDecoder(object):
-    def __init__(self):
+    """Decode terms from any object supporting the buffer protocol (bytes,
+    bytearray, memoryview, mmap, ...).
+
+    Fixed-width fields are read in place, so the only copies made are those
+    of the binaries returned. With borrow_binaries=True, BINARY_EXT and
+    STRING_EXT are returned as memoryview slices of the input instead of
+    bytes, which keeps the input alive (and, for a bytearray or mmap,
+    prevents it from being resized or closed) for as long as they are
+    referenced.
+
+    Lists of integers or floats are decoded in bulk. With
+    numeric_lists="array" (or "numpy"), those made only of integers below
+    2**31 in magnitude, or only of floats in NEW_FLOAT_EXT format, are
+    returned as array.array (or numpy) arrays of C ints or doubles, and
+    STRING_EXT as arrays of unsigned bytes.
+
+    Atoms are interned in atom_cache, an LRUCache (or None to disable it),
+    so the atoms decoded with the same name are the same object. Its size
+    bounds the memory a flood of distinct atoms can take.
+
+    Maps are decoded as dicts, or as FrozenMap when some of their keys
+    aren't hashable (lists, maps) or with frozen_maps=True.
+
+    The length of containers is checked against the bytes left before
+    they are decoded, and compressed terms are only inflated up to their
+    declared size. limits optionally bounds what a term may take further
+    (see DecodeLimits), raising DecodeLimitError when exceeded.
+    """
+
+    def __init__(self, borrow_binaries=False, atom_cache=True, numeric_lists=None,
+                 frozen_maps=False, limits=None):
+        self.borrow_binaries = borrow_binaries
+        self.frozen_maps = frozen_maps
+        self.limits = limits
+        # The limits checked by decode_part, unlimited ones as sys.maxsize
+        if limits is None:
+            self.bounds = (sys.maxsize,) * 3
+        else:
+            self.bounds = tuple(sys.maxsize if limit is None else limit
+                                for limit in (limits.max_depth, limits.max_length, limits.max_atoms))
+        # Readers of the registered records, the size of their tuple header
+        # and tag, their builders and number of fields, by tuple header and
+        # tag (see register_record)
+        self.records = {}
+        if numeric_lists not in (None, "array", "numpy"):
+            raise ValueError("numeric_lists must be None, 'array' or 'numpy'")
+        if numeric_lists == "numpy" and numpy is None:
+            raise ImportError("numeric_lists='numpy' requires numpy")
+        self.numeric_lists = numeric_lists
+        if atom_cache is True:
+            atom_cache = LRUCache(4096)
+        self.atom_cache = atom_cache
         # Cache decode functions to avoid having to do a getattr
         self.decoders = {}
         for k in self.__class__.__dict__:
@@ -22,14 +276,407 @@ class ErlangTermDecoder(object):
                 try: self.decoders[int(k.split('_')[1])] = v
                 except: pass
 
-    def decode(self, buf, offset=0):
+    def register_record(self, tag, cls, fields=None, types=None):
+        """Decode the tuples of the atom tag followed by the given fields
+        as instances of cls, a dataclass or class with __slots__.
+
+        fields defaults to the fields of the dataclass or the slots of the
+        class, and types to their annotations. A reader function is
+        generated for the record, in which the fields annotated as int,
+        float, Atom, bytes or str are read in place when their tag is the
+        expected one (str fields decoding binaries as UTF-8). From the first
+        field holding a tuple, list or map on, fields are decoded on the
+        stack of decode_part like the elements of a tuple, so records nest
+        as deep as other terms and count towards the same limits.
+        Instances are created without calling __init__, as when unpickling.
+        """
+        tag = Atom(tag)
+        fields, types = _record_schema(cls, fields, types)
+        names = ["f%d" % i for i in range(len(fields))]
+        setters = [_FIELD_SETTERS[_has_setattr(cls)].format(name, var) for name, var in zip(fields, names)]
+        lines = ["def read(buf, offset):", "    atoms = 0"]
+        for i, t in enumerate(types):
+            fallback = _FIELD_FALLBACK.format(names[i], ", ".join(names[:i]))
+            if t is not None:
+                fallback = "\n".join("    " + line for line in fallback.split("\n"))
+            lines.append(_FIELD_READERS.get(t, _FIELD_READERS[None]).format(names[i], fallback=fallback))
+        lines.append("    obj = new(cls)")
+        lines.extend(setters)
+        lines.append("    return obj, offset, None, atoms")
+        read = _compile("read", lines, cls=cls, new=cls.__new__, setattr=object.__setattr__,
+                        decode_part=self.decode_part, convert_atom=self.convert_atom,
+                        convert_binary=self.convert_binary)
+        # Creating the record from its fields once decode_part has decoded
+        # those left by read
+        lines = ["def build(items):", "    %s, = items" % ", ".join(names), "    obj = new(cls)"]
+        lines.extend(setters)
+        lines.append("    return obj")
+        build = _compile("build", lines, cls=cls, new=cls.__new__, setattr=object.__setattr__)
+        header = bytes([SMALL_TUPLE_EXT, len(fields) + 1])
+        # The tag may come in any of the atom formats
+        for encoding, long_tag, short_tag in [('latin-1', ATOM_EXT, SMALL_ATOM_EXT),
+                                              ('utf-8', ATOM_UTF8_EXT, SMALL_ATOM_UTF8_EXT)]:
+            try:
+                name = tag.encode(encoding)
+            except UnicodeEncodeError:
+                continue
+            for prefix in (bytes([long_tag]) + _pack_H(len(name)), bytes([short_tag, len(name)])):
+                self.records[header + prefix + name] = (read, len(header + prefix + name), build, len(fields))
+
+    def find_record(self, buf, offset):
+        """Return the reader of the registered record whose tuple starts at
+        offset, the size of its header and tag, its builder and number of
+        fields, or None"""
+        if buf[offset] != SMALL_TUPLE_EXT or not buf[offset+1]:
+            return None
+        tag = buf[offset+2]
+        if tag == SMALL_ATOM_UTF8_EXT or tag == SMALL_ATOM_EXT:
+            end = offset + 4 + buf[offset+3]
+        elif tag == ATOM_EXT or tag == ATOM_UTF8_EXT:
+            end = offset + 5 + _unpack_H(buf, offset+3)[0]
+        else:
+            return None
+        return self.records.get(bytes(buf[offset:end]))
+
+    def decode(self, buf, offset=0, raw=None):
+        """Decode the term at offset in buf.
+
+        raw is an optional collection of paths (see extract) to subterms to
+        be returned as RawTerm instead of being decoded.
+        """
+        buf, offset = self.prepare(buf, offset)
+        spans = None
+        if raw:
+            spans = {}
+            for path in raw:
+                start = self.locate(buf, offset, path)
+                spans[start] = self.skip(buf, start)
+        return self.decode_part(buf, offset, spans)[0]
+
+    def extract(self, buf, path=(), raw=False):
+        """Decode the subterm of the term in buf found by following path, a
+        sequence of tuple and list indexes, skipping over everything else.
+
+        With raw=True, the subterm is returned encoded (with a version byte)
+        instead, e.g. to be forwarded as is.
+        """
+        buf, offset = self.prepare(buf)
+        offset = self.locate(buf, offset, path)
+        if raw:
+            return b"\x83" + buf[offset:self.skip(buf, offset)]
+        return self.decode_part(buf, offset)[0]
+
+    def prepare(self, buf, offset=0):
+        """Check the version of the term at offset in buf and return the
+        buffer to read it from along with the offset of its first tag"""
+        if self.borrow_binaries or not isinstance(buf, bytes):
+            buf = memoryview(buf).cast('B')
         version = buf[offset]
         if version != FORMAT_VERSION:
             raise EncodingError("Bad version number. Expected %d found %d" % (FORMAT_VERSION, version))
-        return self.decode_part(buf, offset+1)[0]
+        limits = self.limits
+        if limits is not None and limits.max_size is not None and len(buf) - offset > limits.max_size:
+            raise DecodeLimitError("Term of %d bytes exceeds the limit of %d" % (len(buf) - offset, limits.max_size))
+        if buf[offset+1] == COMPRESSED:
+            return self.decompress(buf, offset+2)[0], 0
+        return buf, offset+1
+
+    def locate(self, buf, offset, path):
+        """Return the offset of the subterm of the term at offset found by
+        following path"""
+        for index in path:
+            count, offset = self.sequence(buf, offset)
+            if index < 0:
+                index += count
+            if not 0 <= index < count:
+                raise IndexError("Index %d out of range for a term of %d elements" % (index, count))
+            offset, pending = self.scan(buf, offset, index)
+            if pending:
+                raise EncodingError("Truncated term")
+        return offset
 
-    def decode_part(self, buf, offset=0):
-        return self.decoders[buf[offset]](buf, offset+1)
+    def sequence(self, buf, offset):
+        """Return the number of elements of the tuple or list at offset and
+        the offset of its first element"""
+        tag = buf[offset]
+        if tag not in _SEQUENCE_TAGS:
+            raise TypeError("Expected a tuple or list at offset %d, found tag %d instead" % (offset, tag))
+        header, count = self.scan_term(buf, offset, tag, len(buf))
+        if tag == LIST_EXT:
+            # Not the tail
+            count -= 1
+        return count, offset + header
+
+    def skip(self, buf, offset=0, compressed=False):
+        """Return the offset just past the end of the term at offset, which
+        may be compressed if compressed is true (see scan)"""
+        offset, pending = self.scan(buf, offset, compressed=compressed)
+        if pending:
+            raise EncodingError("Truncated term")
+        return offset
+
+    def decode_part(self, buf, offset=0, raw=None):
+        """Decode the term at offset and return it with the offset just past
+        its end.
+
+        Tuples and lists are built on an explicit stack of containers under
+        construction instead of by recursion, so the nesting depth of a term
+        is only bounded by memory. Every other tag is handed to its decode_*
+        method. raw optionally maps the offsets of subterms to be returned
+        as RawTerm to their end.
+        """
+        decoders = self.decoders
+        atom_cache = self.atom_cache
+        records = self.records
+        copy_binaries = not self.borrow_binaries and buf.__class__ is not bytes
+        max_depth, max_length, max_atoms = self.bounds
+        end = len(buf)
+        atoms = 0
+        # The innermost container under construction is kept in kind,
+        # count and items, its ancestors on the stack
+        stack = []
+        kind = count = items = None
+        while True:
+            tag = buf[offset]
+            if raw is not None and offset in raw:
+                val = RawTerm(buf[offset:raw[offset]])
+                offset = raw[offset]
+            elif tag == SMALL_INTEGER_EXT:
+                val = buf[offset+1]
+                offset += 2
+            elif tag == INTEGER_EXT:
+                val = _unpack_l(buf, offset+1)[0]
+                offset += 5
+            elif tag == BINARY_EXT:
+                length = _unpack_L(buf, offset+1)[0]
+                offset += 5
+                val = buf[offset:offset+length]
+                if copy_binaries:
+                    val = bytes(val)
+                offset += length
+            elif tag in _ATOM_ENCODINGS:
+                atoms += 1
+                if atoms > max_atoms:
+                    raise DecodeLimitError("Term of more than %d atoms" % max_atoms)
+                if tag == ATOM_EXT or tag == ATOM_UTF8_EXT:
+                    start = offset + 3
+                    offset = start + _unpack_H(buf, offset+1)[0]
+                else:
+                    start = offset + 2
+                    offset = start + buf[offset+1]
+                encoding = _ATOM_ENCODINGS[tag]
+                if atom_cache is None:
+                    val = self.new_atom(buf[start:offset], encoding)
+                else:
+                    # As in convert_atom
+                    name = bytes(buf[start:offset])
+                    key = name if encoding == 'latin-1' or name.isascii() else (name, encoding)
+                    val = atom_cache.get(key, _MISSING)
+                    if val is _MISSING:
+                        val = atom_cache[key] = self.new_atom(name, encoding)
+            elif tag == SMALL_TUPLE_EXT or tag == LARGE_TUPLE_EXT:
+                record = self.find_record(buf, offset) if records and raw is None else None
+                if record is not None:
+                    read, size, build, fields = record
+                    if len(stack) >= max_depth:
+                        self.check_length("Tuple", fields + 1, end - offset, len(stack))
+                    val, offset, items_read, read_atoms = read(buf, offset + size)
+                    # The tag is an atom too
+                    atoms += read_atoms + 1
+                    if atoms > max_atoms:
+                        raise DecodeLimitError("Term of more than %d atoms" % max_atoms)
+                    if items_read is not None:
+                        # Stopped at a field nesting other terms
+                        stack.append((kind, count, items))
+                        kind, count, items = build, fields, items_read
+                        continue
+                else:
+                    if tag == SMALL_TUPLE_EXT:
+                        arity = buf[offset+1]
+                        offset += 2
+                    else:
+                        arity = _unpack_L(buf, offset+1)[0]
+                        offset += 5
+                    if arity:
+                        if arity > max_length or arity > end - offset or len(stack) >= max_depth:
+                            self.check_length("Tuple", arity, end - offset, len(stack))
+                        stack.append((kind, count, items))
+                        kind, count, items = SMALL_TUPLE_EXT, arity, []
+                        continue
+                    val = ()
+            elif tag == MAP_EXT:
+                arity = _unpack_L(buf, offset+1)[0]
+                offset += 5
+                if arity:
+                    if arity > max_length or 2*arity > end - offset or len(stack) >= max_depth:
+                        self.check_length("Map", arity, end - offset, len(stack))
+                    stack.append((kind, count, items))
+                    # Keys and values alternate
+                    kind, count, items = MAP_EXT, 2*arity, []
+                    continue
+                val = FrozenMap() if self.frozen_maps else {}
+            elif tag == LIST_EXT:
+                length = _unpack_L(buf, offset+1)[0]
+                offset += 5
+                # One more item for the tail
+                if length > max_length or length >= end - offset or len(stack) >= max_depth:
+                    self.check_length("List", length, end - offset, len(stack))
+                if length and raw is None and buf[offset] in _NUMBER_RUNS:
+                    val, offset = self.decode_numbers(buf, offset, length)
+                    if len(val) == length and buf[offset] == NIL_EXT:
+                        val = self.convert_numbers(val)
+                        offset += 1
+                    else:
+                        # Carry on with the generic path, converting the
+                        # list once complete if it turns out to be numeric
+                        stack.append((kind, count, items))
+                        kind = _NUMBER_LIST if self.numeric_lists else LIST_EXT
+                        count, items = length+1, list(val)
+                        continue
+                else:
+                    stack.append((kind, count, items))
+                    kind, count, items = LIST_EXT, length+1, []
+                    continue
+            else:
+                val, offset = decoders[tag](buf, offset+1)
+
+            # Hand the value to the innermost container and close every
+            # container it completes
+            while True:
+                if items is None:
+                    return val, offset
+                items.append(val)
+                if len(items) < count:
+                    break
+                if kind == SMALL_TUPLE_EXT:
+                    val = tuple(items)
+                elif kind == MAP_EXT:
+                    val = self.convert_map(items)
+                elif kind.__class__ is not int:
+                    # The builder of a record
+                    val = kind(items)
+                else:
+                    tail = items.pop()
+                    if tail != []:
+                        # TODO: Not sure what to do with the tail
+                        raise NotImplementedError("Lists with non empty tails are not supported")
+                    val = items
+                    if kind == _NUMBER_LIST:
+                        val = self.convert_numbers(self.pack_numbers(items))
+                kind, count, items = stack.pop()
+
+    def scan(self, buf, offset=0, pending=1, compressed=False):
+        """Skip over pending consecutive terms starting at offset without
+        decoding them and return (offset, pending).
+
+        pending is 0 once all the terms have been skipped, offset then being
+        just past the last one. If buf ends first, offset is the start of
+        the first incomplete term and pending the number of terms still to
+        skip, to be passed back in once more data is available.
+
+        Compressed terms are only allowed right after the version byte:
+        with compressed=True, the term at offset is such a whole term, and
+        may be compressed.
+        """
+        end = len(buf)
+        if compressed and pending == 1 and offset < end and buf[offset] == COMPRESSED:
+            size = self.scan_compressed(buf, offset, end)
+            if size is None:
+                return offset, pending
+            return offset + size, 0
+        while pending and offset < end:
+            try:
+                tag = buf[offset]
+                size, children = self.scan_term(buf, offset, tag, end)
+            except (IndexError, struct.error):
+                break
+            if size is None or offset + size > end:
+                break
+            offset += size
+            pending += children - 1
+        return offset, pending
+
+    def scan_term(self, buf, offset, tag, end):
+        """Return the size of the term at offset, excluding that of the
+        terms nested in it, and the number of such terms. The size is None
+        if it can't be known before the end of the buffer."""
+        size = _SCALAR_SIZES.get(tag)
+        if size is not None:
+            return size, 0
+        if tag == ATOM_EXT or tag == STRING_EXT:
+            return 3 + _unpack_H(buf, offset+1)[0], 0
+        elif tag == SMALL_ATOM_EXT or tag == SMALL_ATOM_UTF8_EXT:
+            return 2 + buf[offset+1], 0
+        elif tag == ATOM_UTF8_EXT:
+            return 3 + _unpack_H(buf, offset+1)[0], 0
+        elif tag == BINARY_EXT:
+            return 5 + _unpack_L(buf, offset+1)[0], 0
+        elif tag == BIT_BINARY_EXT:
+            return 6 + _unpack_L(buf, offset+1)[0], 0
+        elif tag == SMALL_BIG_EXT:
+            return 3 + buf[offset+1], 0
+        elif tag == LARGE_BIG_EXT:
+            return 6 + _unpack_L(buf, offset+1)[0], 0
+        elif tag == SMALL_TUPLE_EXT:
+            return 2, buf[offset+1]
+        elif tag == LARGE_TUPLE_EXT:
+            return 5, _unpack_L(buf, offset+1)[0]
+        elif tag == MAP_EXT:
+            return 5, 2 * _unpack_L(buf, offset+1)[0]
+        elif tag == LIST_EXT:
+            return 5, _unpack_L(buf, offset+1)[0] + 1
+        elif tag == REFERENCE_EXT or tag == PORT_EXT:
+            return 6 + self.scan_atom(buf, offset+1), 0
+        elif tag == PID_EXT:
+            return 10 + self.scan_atom(buf, offset+1), 0
+        elif tag == NEW_REFERENCE_EXT:
+            return 4 + self.scan_atom(buf, offset+3) + 4 * _unpack_H(buf, offset+1)[0], 0
+        elif tag == NEWER_REFERENCE_EXT:
+            return 7 + self.scan_atom(buf, offset+3) + 4 * _unpack_H(buf, offset+1)[0], 0
+        elif tag == NEW_PID_EXT or tag == V4_PORT_EXT:
+            return 13 + self.scan_atom(buf, offset+1), 0
+        elif tag == NEW_PORT_EXT:
+            return 9 + self.scan_atom(buf, offset+1), 0
+        elif tag == EXPORT_EXT:
+            return 1, 3
+        elif tag == NEW_FUN_EXT:
+            return 1 + _unpack_L(buf, offset+1)[0], 0
+        elif tag == FUN_EXT:
+            return 5, 4 + _unpack_L(buf, offset+1)[0]
+        elif tag == COMPRESSED:
+            raise EncodingError("Compressed term nested in a term at offset %d" % offset)
+        raise EncodingError("Unknown tag %d at offset %d" % (tag, offset))
+
+    def scan_compressed(self, buf, offset, end):
+        """Return the size of the compressed term at offset (its tag
+        included), or None if it doesn't end before end"""
+        if end - offset < 5:
+            return None
+        # The compressed size isn't recorded, the data has to be inflated
+        # to find where it ends
+        usize = _unpack_L(buf, offset+1)[0]
+        self.check_decompressed(usize)
+        inflater = zlib.decompressobj()
+        data = buf[offset+5:end]
+        inflated = 0
+        while not inflater.eof:
+            size = len(inflater.decompress(data, 65536))
+            inflated += size
+            if inflated > usize:
+                raise EncodingError("Compressed term larger than its declared size of %d bytes" % usize)
+            data = inflater.unconsumed_tail
+            if not size and not data:
+                # Needs more input
+                return None
+        return end - offset - len(inflater.unused_data)
+
+    def scan_atom(self, buf, offset):
+        tag = buf[offset]
+        if tag == ATOM_EXT or tag == ATOM_UTF8_EXT:
+            return 3 + _unpack_H(buf, offset+1)[0]
+        elif tag == SMALL_ATOM_EXT or tag == SMALL_ATOM_UTF8_EXT:
+            return 2 + buf[offset+1]
+        raise EncodingError("Expected atom at offset %d, found tag %d instead" % (offset, tag))
 
     def decode_97(self, buf, offset):
         """SMALL_INTEGER_EXT"""
@@ -37,19 +684,19 @@ class ErlangTermDecoder(object):
 
     def decode_98(self, buf, offset):
         """INTEGER_EXT"""
-        return struct.unpack(">l", buf[offset:offset+4])[0], offset+4
+        return _unpack_l(buf, offset)[0], offset+4
 
     def decode_99(self, buf, offset):
         """FLOAT_EXT"""
-        return float(buf[offset:offset+31].split(b'\x00', 1)[0]), offset+31
+        return float(bytes(buf[offset:offset+31]).split(b'\x00', 1)[0]), offset+31
 
     def decode_70(self, buf, offset):
         """NEW_FLOAT_EXT"""
-        return struct.unpack(">d", buf[offset:offset+8])[0], offset+8
+        return _unpack_d(buf, offset)[0], offset+8
 
     def decode_100(self, buf, offset):
         """ATOM_EXT"""
-        atom_len = struct.unpack(">H", buf[offset:offset+2])[0]
+        atom_len = _unpack_H(buf, offset)[0]
         atom = buf[offset+2:offset+2+atom_len]
         return self.convert_atom(atom), offset+atom_len+2
 
@@ -59,27 +706,17 @@ class ErlangTermDecoder(object):
         atom = buf[offset+1:offset+1+atom_len]
         return self.convert_atom(atom), offset+atom_len+1
 
-    def decode_104(self, buf, offset):
-        """SMALL_TUPLE_EXT"""
-        arity = buf[offset]
-        offset += 1
-
-        items = []
-        for i in range(arity):
-            val, offset = self.decode_part(buf, offset)
-            items.append(val)
-        return tuple(items), offset
-
-    def decode_105(self, buf, offset):
-        """LARGE_TUPLE_EXT"""
-        arity = struct.unpack(">L", buf[offset:offset+4])[0]
-        offset += 4
+    def decode_118(self, buf, offset):
+        """ATOM_UTF8_EXT"""
+        atom_len = _unpack_H(buf, offset)[0]
+        atom = buf[offset+2:offset+2+atom_len]
+        return self.convert_atom(atom, 'utf-8'), offset+atom_len+2
 
-        items = []
-        for i in range(arity):
-            val, offset = self.decode_part(buf, offset)
-            items.append(val)
-        return tuple(items), offset
+    def decode_119(self, buf, offset):
+        """SMALL_ATOM_UTF8_EXT"""
+        atom_len = buf[offset]
+        atom = buf[offset+1:offset+1+atom_len]
+        return self.convert_atom(atom, 'utf-8'), offset+atom_len+1
 
     def decode_106(self, buf, offset):
         """NIL_EXT"""
@@ -87,28 +724,102 @@ class ErlangTermDecoder(object):
 
     def decode_107(self, buf, offset):
         """STRING_EXT"""
-        length = struct.unpack(">H", buf[offset:offset+2])[0]
+        length = _unpack_H(buf, offset)[0]
         st = buf[offset+2:offset+2+length]
-        return st, offset+2+length
+        if self.numeric_lists is not None:
+            return self.convert_numbers(array.array('B', st)), offset+2+length
+        return self.convert_binary(st), offset+2+length
 
-    def decode_108(self, buf, offset):
-        """LIST_EXT"""
-        length = struct.unpack(">L", buf[offset:offset+4])[0]
-        offset += 4
-        items = []
-        for i in range(length):
-            val, offset = self.decode_part(buf, offset)
-            items.append(val)
-        tail, offset = self.decode_part(buf, offset)
-        if tail != []:
-            # TODO: Not sure what to do with the tail
-            raise NotImplementedError("Lists with non empty tails are not supported")
-        return items, offset
+    def decode_numbers(self, buf, offset, count):
+        """Decode the run of up to count SMALL_INTEGER_EXT, INTEGER_EXT and
+        NEW_FLOAT_EXT terms at offset and return it along with the offset
+        past its end.
+
+        The tags and values are copied out with strided slices, a few per
+        run of identical tags rather than a step per element. Runs shorter
+        than _MIN_RUN that don't end the list stop the bulk decoding. The
+        result is an array.array ('i' for integers, 'd' for floats) or a
+        list if they are mixed, and is empty if there is no run to decode.
+        """
+        result = []
+        while count:
+            tag = buf[offset]
+            size = _NUMBER_RUNS.get(tag)
+            if size is None:
+                break
+            # Every size bytes from offset, the tags up to the first one that
+            # differs make the run. They are compared in windows of growing
+            # size so that short runs in long lists stay cheap.
+            tag_byte = _TAG_BYTES[tag]
+            n = 0
+            window = 16
+            while n < count:
+                window = min(window, count - n)
+                start = offset + size * n
+                tags = bytes(buf[start:start + size * window:size])
+                matched = len(tags) - len(tags.lstrip(tag_byte))
+                n += matched
+                if matched < window:
+                    break
+                window *= 2
+            short = n < _MIN_RUN
+            if short and n < count:
+                # Not worth it, leave the rest to decode_part
+                break
+            end = offset + size * n
+            if end > len(buf):
+                raise EncodingError("Truncated term")
+            typecode = 'd' if tag == NEW_FLOAT_EXT else 'i'
+            if tag == SMALL_INTEGER_EXT:
+                values = bytes(buf[offset+1:end:2])
+            elif short:
+                unpack = _unpack_d if tag == NEW_FLOAT_EXT else _unpack_l
+                values = [unpack(buf, i)[0] for i in range(offset+1, end, size)]
+            else:
+                width = size - 1
+                data = bytearray(width * n)
+                for i in range(width):
+                    data[i::width] = bytes(buf[offset+1+i:end:size])
+                values = array.array(typecode)
+                values.frombytes(data)
+                if sys.byteorder == 'little':
+                    values.byteswap()
+            if result.__class__ is list and not result:
+                result = array.array(typecode)
+            if result.__class__ is not list and result.typecode != typecode:
+                result = result.tolist()
+            result.extend(values)
+            offset = end
+            count -= n
+        return result, offset
+
+    def pack_numbers(self, items):
+        """Return the list items as an array.array if they are all integers
+        fitting in 32 bits or all floats, or else as is"""
+        types = set(map(type, items))
+        if types == _INT_TYPE:
+            try:
+                return array.array('i', items)
+            except OverflowError:
+                pass
+        elif types == _FLOAT_TYPE:
+            return array.array('d', items)
+        return items
+
+    def convert_numbers(self, values):
+        mode = self.numeric_lists
+        if values.__class__ is list:
+            return values
+        elif mode is None:
+            return values.tolist()
+        elif mode == "numpy":
+            return numpy.frombuffer(values, dtype=values.typecode)
+        return values
 
     def decode_109(self, buf, offset):
         """BINARY_EXT"""
-        length = struct.unpack(">L", buf[offset:offset+4])[0]
-        return buf[offset+4:offset+4+length], offset+4+length
+        length = _unpack_L(buf, offset)[0]
+        return self.convert_binary(buf[offset+4:offset+4+length]), offset+4+length
 
     def decode_110(self, buf, offset):
         """SMALL_BIG_EXT"""
@@ -118,57 +829,85 @@ class ErlangTermDecoder(object):
 
     def decode_111(self, buf, offset):
         """LARGE_BIG_EXT"""
-        n = struct.unpack(">L", buf[offset:offset+4])[0]
+        n = _unpack_L(buf, offset)[0]
         offset += 4
         return self.decode_bigint(n, buf, offset)
 
     def decode_bigint(self, n, buf, offset):
         sign = buf[offset]
         offset += 1
-        b = 1
-        val = 0
-        for i in range(n):
-            val += buf[offset] * b
-            b <<= 8
-            offset += 1
+        val = int.from_bytes(buf[offset:offset+n], 'little')
         if sign != 0:
             val = -val
-        return val, offset
+        return val, offset+n
 
     def decode_101(self, buf, offset):
         """REFERENCE_EXT"""
         node, offset = self.decode_part(buf, offset)
         if not isinstance(node, Atom):
             raise EncodingError("Expected atom while parsing REFERENCE_EXT, found %r instead" % node)
-        reference_id, creation = struct.unpack(">LB", buf[offset:offset+5])
+        reference_id, creation = struct.unpack_from(">LB", buf, offset)
         return Reference(node, [reference_id], creation), offset+5
 
     def decode_114(self, buf, offset):
         """NEW_REFERENCE_EXT"""
-        id_len = struct.unpack(">H", buf[offset:offset+2])[0]
+        id_len = _unpack_H(buf, offset)[0]
         node, offset = self.decode_part(buf, offset+2)
         if not isinstance(node, Atom):
             raise EncodingError("Expected atom while parsing NEW_REFERENCE_EXT, found %r instead" % node)
         creation = buf[offset]
-        reference_id = struct.unpack(">%dL" % id_len, buf[offset+1:offset+1+4*id_len])
+        reference_id = struct.unpack_from(">%dL" % id_len, buf, offset+1)
         return Reference(node, reference_id, creation), offset+1+4*id_len
 
+    def decode_90(self, buf, offset):
+        """NEWER_REFERENCE_EXT"""
+        id_len = _unpack_H(buf, offset)[0]
+        node, offset = self.decode_part(buf, offset+2)
+        if not isinstance(node, Atom):
+            raise EncodingError("Expected atom while parsing NEWER_REFERENCE_EXT, found %r instead" % node)
+        values = struct.unpack_from(">%dL" % (id_len + 1), buf, offset)
+        return Reference(node, values[1:], values[0]), offset+4+4*id_len
+
     def decode_102(self, buf, offset):
         """PORT_EXT"""
         node, offset = self.decode_part(buf, offset)
         if not isinstance(node, Atom):
             raise EncodingError("Expected atom while parsing PORT_EXT, found %r instead" % node)
-        port_id, creation = struct.unpack(">LB", buf[offset:offset+5])
+        port_id, creation = struct.unpack_from(">LB", buf, offset)
         return Port(node, port_id, creation), offset+5
 
+    def decode_89(self, buf, offset):
+        """NEW_PORT_EXT"""
+        node, offset = self.decode_part(buf, offset)
+        if not isinstance(node, Atom):
+            raise EncodingError("Expected atom while parsing NEW_PORT_EXT, found %r instead" % node)
+        port_id, creation = struct.unpack_from(">LL", buf, offset)
+        return Port(node, port_id, creation), offset+8
+
+    def decode_120(self, buf, offset):
+        """V4_PORT_EXT"""
+        node, offset = self.decode_part(buf, offset)
+        if not isinstance(node, Atom):
+            raise EncodingError("Expected atom while parsing V4_PORT_EXT, found %r instead" % node)
+        port_id, creation = struct.unpack_from(">QL", buf, offset)
+        return Port(node, port_id, creation), offset+12
+
     def decode_103(self, buf, offset):
         """PID_EXT"""
         node, offset = self.decode_part(buf, offset)
         if not isinstance(node, Atom):
             raise EncodingError("Expected atom while parsing PID_EXT, found %r instead" % node)
-        pid_id, serial, creation = struct.unpack(">LLB", buf[offset:offset+9])
+        pid_id, serial, creation = struct.unpack_from(">LLB", buf, offset)
         return PID(node, pid_id, serial, creation), offset+9
 
+    def decode_88(self, buf, offset):
+        """NEW_PID_EXT"""
+        node, offset = self.decode_part(buf, offset)
+        if not isinstance(node, Atom):
+            raise EncodingError("Expected atom while parsing NEW_PID_EXT, found %r instead" % node)
+        pid_id, serial, creation = struct.unpack_from(">LLL", buf, offset)
+        return PID(node, pid_id, serial, creation), offset+12
+
     def decode_113(self, buf, offset):
         """EXPORT_EXT"""
         module, offset = self.decode_part(buf, offset)
@@ -180,33 +919,217 @@ class ErlangTermDecoder(object):
         arity, offset = self.decode_part(buf, offset)
         if not isinstance(arity, int):
             raise EncodingError("Expected integer while parsing EXPORT_EXT, found %r instead" % arity)
-        return Export(module, function, arity), offset+1
+        return Export(module, function, arity), offset
 
     def decode_80(self, buf, offset):
-        """Compressed term"""
-        usize = struct.unpack(">L", buf[offset:offset+4])[0]
-        buf = zlib.decompress(buf[offset+4:offset+4+usize])
-        return self.decode_part(buf, 0)
+        """Compressed term, which is only allowed right after the version
+        byte, where prepare() inflates it"""
+        raise EncodingError("Compressed term nested in a term at offset %d" % (offset - 1))
+
+    def decompress(self, buf, offset):
+        """Inflate the compressed term at offset (past its tag) and return
+        it along with the offset just past its end. No more than its
+        declared size is inflated."""
+        usize = _unpack_L(buf, offset)[0]
+        self.check_decompressed(usize)
+        inflater = zlib.decompressobj()
+        data = inflater.decompress(buf[offset+4:], usize)
+        if not inflater.eof and len(data) == usize:
+            # What's left should only be the end of the stream
+            if inflater.decompress(inflater.unconsumed_tail, 1):
+                raise EncodingError("Compressed term larger than its declared size of %d bytes" % usize)
+        if not inflater.eof or len(data) != usize:
+            raise EncodingError("Truncated or corrupt compressed term")
+        return data, len(buf) - len(inflater.unused_data)
+
+    def check_decompressed(self, usize):
+        if not usize:
+            # No term is empty, and zlib takes a max_length of 0 as no limit
+            raise EncodingError("Compressed term with a declared size of 0")
+        limits = self.limits
+        if limits is not None and limits.max_decompressed is not None and usize > limits.max_decompressed:
+            raise DecodeLimitError("Compressed term of %d bytes once inflated exceeds the limit of %d"
+                                   % (usize, limits.max_decompressed))
+
+    def check_length(self, kind, length, left, depth):
+        """Raise the appropriate error for a container of length elements
+        at the given depth with left bytes to encode them"""
+        max_depth, max_length, max_atoms = self.bounds
+        if depth >= max_depth:
+            raise DecodeLimitError("Terms nested more than %d deep" % max_depth)
+        elif length > max_length:
+            raise DecodeLimitError("%s of %d elements exceeds the limit of %d" % (kind, length, max_length))
+        raise EncodingError("Truncated term: %s of %d elements in %d bytes" % (kind, length, left))
 
-    def convert_atom(self, atom):
+    def convert_atom(self, atom, encoding='latin-1'):
+        cache = self.atom_cache
+        if cache is None:
+            return self.new_atom(atom, encoding)
+        atom = bytes(atom)
+        # Atoms are looked up by their encoded name, which is the same in
+        # latin-1 and UTF-8 as long as it is ASCII
+        key = atom if encoding == 'latin-1' or atom.isascii() else (atom, encoding)
+        value = cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = cache[key] = self.new_atom(atom, encoding)
+        return value
+
+    def new_atom(self, atom, encoding='latin-1'):
         if atom == b"true":
             return True
         elif atom == b"false":
             return False
         elif atom == b"none":
             return None
-        return Atom(atom.decode('latin-1'))
+        return Atom(str(atom, encoding))
+
+    def convert_map(self, items):
+        pairs = zip(items[::2], items[1::2])
+        if not self.frozen_maps:
+            try:
+                result = dict(pairs)
+                if 2 * len(result) == len(items):
+                    return result
+                # Keys different in Erlang but equal in Python, such as 1
+                # and 1.0, which FrozenMap tells apart
+            except TypeError:
+                # Unhashable key
+                pass
+            pairs = zip(items[::2], items[1::2])
+        result = FrozenMap(pairs)
+        if 2 * len(result) != len(items):
+            # Such as a string and a binary, both decoded as bytes
+            raise EncodingError("Map with keys that can't be told apart once decoded")
+        return result
+
+    def convert_binary(self, binary):
+        if self.borrow_binaries or binary.__class__ is bytes:
+            return binary
+        return bytes(binary)
+
+class LazyTerm(object):
+    """An encoded tuple or list whose elements are only decoded when
+    accessed.
+
+    Indexing (or iterating) returns a LazyTerm for the elements that are
+    tuples or lists themselves, and the decoded element otherwise.
+    """
+
+    def __init__(self, buf, offset=None, decoder=None):
+        self.decoder = decoder or ErlangTermDecoder()
+        if offset is None:
+            buf, offset = self.decoder.prepare(buf)
+        self.buf = buf
+        self.offset = offset
+        self.count, self.first = self.decoder.sequence(buf, offset)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not isinstance(index, int):
+            raise TypeError("LazyTerm indices must be integers")
+        return self.element(self.decoder.locate(self.buf, self.offset, (index,)))
+
+    def __iter__(self):
+        offset = self.first
+        for i in range(self.count):
+            yield self.element(offset)
+            offset = self.decoder.skip(self.buf, offset)
+
+    def __repr__(self):
+        return "LazyTerm(%r)" % self.raw
+
+    def element(self, offset):
+        if self.buf[offset] in _SEQUENCE_TAGS:
+            return LazyTerm(self.buf, offset, self.decoder)
+        return self.decoder.decode_part(self.buf, offset)[0]
+
+    def extract(self, path=(), raw=False):
+        """Decode the subterm found by following path, or return it encoded
+        with raw=True (see ErlangTermDecoder.extract)"""
+        offset = self.decoder.locate(self.buf, self.offset, path)
+        if raw:
+            return b"\x83" + self.buf[offset:self.decoder.skip(self.buf, offset)]
+        return self.decoder.decode_part(self.buf, offset)[0]
+
+    def decode(self):
+        return self.extract()
+
+    @property
+    def raw(self):
+        return self.extract(raw=True)
 
 class ErlangTermEncoder(object):
-    def __init__(self, encoding="utf-8", unicode_type="binary"):
+    """Encode Python objects as terms.
+
+    profile selects the tags used for floats, atoms and identifiers:
+    "legacy" (the default) sticks to those understood by any Erlang
+    release, FLOAT_EXT, ATOM_EXT and the PID, port and reference tags with
+    8-bit creations. "modern" emits the smaller and faster NEW_FLOAT_EXT,
+    SMALL_ATOM_UTF8_EXT/ATOM_UTF8_EXT and NEW_PID_EXT, NEW_PORT_EXT (or
+    V4_PORT_EXT) and NEWER_REFERENCE_EXT, as OTP 23 and later do.
+
+    dicts (and FrozenMap) are encoded as maps, their keys in iteration
+    order, or with sort_map_keys=True sorted by their encoding so that
+    equal maps are always encoded the same way.
+
+    compression is the CompressionPolicy applied by encode() unless told
+    otherwise, None for no compression.
+    """
+
+    def __init__(self, encoding="utf-8", unicode_type="binary", cache=None, atom_cache=True,
+                 profile="legacy", sort_map_keys=False, compression=None):
+        if profile not in ("legacy", "modern"):
+            raise ValueError("profile must be 'legacy' or 'modern'")
+        self.compression = compression
         self.encoding = encoding
         self.unicode_type = unicode_type
+        self.profile = profile
+        self.sort_map_keys = sort_map_keys
+        modern = profile == "modern"
+        # Bound once, as iterencode tells maps apart by the identity of
+        # their encoder
+        encode_map = self.encode_map
+        # Encoders are looked up by the exact type of the object; subclasses
+        # are resolved through their MRO on first sight (see find_encoder)
+        self.encoders = {
+            bool: self.encode_bool,
+            type(None): self.encode_none,
+            int: self.encode_int,
+            float: self.encode_new_float if modern else self.encode_float,
+            Atom: self.encode_atom,
+            str: self.encode_str,
+            bytes: self.encode_bytes,
+            tuple: self.encode_tuple,
+            list: self.encode_list,
+            dict: encode_map,
+            FrozenMap: encode_map,
+            Reference: self.encode_newer_reference if modern else self.encode_reference,
+            Port: self.encode_new_port if modern else self.encode_port,
+            PID: self.encode_new_pid if modern else self.encode_pid,
+            Export: self.encode_export,
+            RawTerm: self.encode_raw,
+            array.array: self.encode_array,
+            memoryview: self.encode_memoryview,
+        }
+        if numpy is not None:
+            self.encoders[numpy.ndarray] = self.encode_ndarray
+        self.true, self.false, self.none = [self.new_atom(name) for name in ("true", "false", "none")]
+        # Encoded atoms, by name
+        if atom_cache is True:
+            atom_cache = LRUCache(4096)
+        self.atom_cache = atom_cache
+        # Encoded values of the other types that are immutable and hashable
+        if cache is True:
+            cache = LRUCache()
+        self.cache = cache
+        if cache is not None:
+            for cls in (Reference, Port, PID, Export):
+                self.encoders[cls] = self.cached_encoder(self.encoders[cls])
+            self.encoders[tuple] = self.cached_tuple_encoder(self.encode_tuple)
 
-    def encode(self, obj, compressed=False):
-        import sys
-        import pprint
-        #pprint.pprint(self.encode_part(obj),stream=sys.stderr)
-        ubuf = b"".join(self.encode_part(obj))
+    def compression_level(self, compressed):
         if compressed is True:
             compressed = 6
         if not (compressed is False \
@@ -214,83 +1137,487 @@ class ErlangTermEncoder(object):
                             and compressed >= 0 and compressed <= 9)):
             raise TypeError("compressed must be True, False or "
                             "an integer between 0 and 9")
-        if compressed:
-            cbuf = zlib.compress(ubuf, compressed)
-            if len(cbuf) < len(ubuf):
-                usize = struct.pack(">L", len(ubuf))
-                ubuf = "".join([COMPRESSED, usize, cbuf])
-        return bytes([FORMAT_VERSION]) + ubuf
-
-    def encode_part(self, obj):
-        if obj is False:
-            return [bytes([ATOM_EXT]), struct.pack(">H", 5), b"false"]
-        elif obj is True:
-            return [bytes([ATOM_EXT]), struct.pack(">H", 4), b"true"]
-        elif obj is None:
-            return [bytes([ATOM_EXT]), struct.pack(">H", 4), b"none"]
-        elif isinstance(obj, int):
-            if 0 <= obj <= 255:
-                return [bytes([SMALL_INTEGER_EXT,obj])]
-            elif -2147483648 <= obj <= 2147483647:
-                return [bytes([INTEGER_EXT]), struct.pack(">l", obj)]
+        return compressed
+
+    def encode(self, obj, compressed=None):
+        """Encode obj with the version byte.
+
+        compressed is True, False or a zlib level, in which case the term
+        is compressed if that makes it smaller, or a CompressionPolicy (any
+        object with the same compress method). It defaults to the policy
+        of the encoder, compression, if any.
+        """
+        if compressed is None:
+            compressed = self.compression or False
+        if isinstance(compressed, int):
+            level = self.compression_level(compressed)
+        elif not hasattr(compressed, "compress"):
+            raise TypeError("compressed must be True, False, an integer between 0 and 9 "
+                            "or a CompressionPolicy")
+        buf = bytearray([FORMAT_VERSION])
+        self.encode_part(obj, buf)
+        if not isinstance(compressed, int):
+            with memoryview(buf) as view:
+                cbuf = compressed.compress(view[1:])
+        elif level:
+            cbuf = zlib.compress(buf[1:], level)
+            if len(cbuf) >= len(buf) - 1:
+                cbuf = None
+        else:
+            cbuf = None
+        if cbuf is not None:
+            usize = len(buf) - 1
+            del buf[1:]
+            buf.append(COMPRESSED)
+            buf += _pack_L(usize)
+            buf += cbuf
+        return bytes(buf)
+
+    def encode_into(self, obj, buffer, offset=0):
+        """Encode obj (with the version byte) into buffer at offset and
+        return the offset just past the end of the term.
+
+        A bytearray is truncated at offset (or padded with zeros up to it)
+        and grown in place, which allows a single buffer to be reused for
+        every message, or room to be left in front of the term for a packet
+        header. Any other writable buffer (memoryview, mmap, ...) must be
+        large enough to hold the term.
+        """
+        if offset < 0:
+            raise ValueError("Negative offset %d" % offset)
+        if isinstance(buffer, bytearray):
+            if offset > len(buffer):
+                buffer.extend(bytes(offset - len(buffer)))
             else:
-                sign = obj < 0
-                obj = abs(obj)
+                del buffer[offset:]
+            buffer.append(FORMAT_VERSION)
+            self.encode_part(obj, buffer)
+            return len(buffer)
+        buf = bytearray([FORMAT_VERSION])
+        self.encode_part(obj, buf)
+        end = offset + len(buf)
+        if end > len(buffer):
+            raise ValueError("Buffer too small: %d bytes needed at offset %d, "
+                             "%d available" % (len(buf), offset, len(buffer) - offset))
+        buffer[offset:end] = buf
+        return end
+
+    def iterencode(self, obj, chunk_size=65536, compressed=False):
+        """Encode obj (with the version byte) and return an iterator over
+        the encoded term in chunks of about chunk_size bytes.
+
+        Lists and tuples (other than those only made of scalars, which are
+        encoded in one go) are walked on an explicit stack, their headers
+        being written from their length, and the data encoded so far is
+        handed out every time it reaches chunk_size. Binaries at least that
+        large are handed out as is. The memory used is thus bounded by
+        chunk_size and the largest term that isn't a list or tuple, rather
+        than by the size of the whole term.
 
-                big_buf = []
-                while obj > 0:
-                    big_buf.append(obj & 0xff)
-                    obj >>= 8
+        With compressed (True or a zlib level, as compression policies
+        need the whole term), the chunks are deflated on the fly. The
+        uncompressed size comes first in a compressed term, so obj is then
+        encoded twice, the first time only to count its bytes. Unlike
+        encode(), the term is compressed even if that doesn't make it
+        smaller.
+        """
+        level = self.compression_level(compressed)
+        if level:
+            return self.iterencode_compressed(obj, chunk_size, level)
+        return self.iterencode_chunks(obj, chunk_size)
 
-                if len(big_buf) < 256:
-                    return [bytes([SMALL_BIG_EXT,len(big_buf),sign]),bytes(big_buf)]
+    def iterencode_chunks(self, obj, chunk_size):
+        encoders = self.encoders
+        encode_list = encoders[list]
+        encode_tuple = encoders[tuple]
+        encode_map = encoders[dict]
+        buf = bytearray([FORMAT_VERSION])
+        # Iterators over the containers being encoded, and whether they are
+        # lists, which end with a tail
+        stack = [(iter((obj,)), False)]
+        while stack:
+            items, is_list = stack[-1]
+            for item in items:
+                encoder = encoders.get(item.__class__)
+                if encoder is None:
+                    encoder = self.find_encoder(item)
+                if encoder is encode_list and item:
+                    buf.append(LIST_EXT)
+                    buf += _pack_L(len(item))
+                    stack.append((iter(item), True))
+                    break
+                elif encoder is encode_map:
+                    buf.append(MAP_EXT)
+                    buf += _pack_L(len(item))
+                    if self.sort_map_keys:
+                        pairs = [(RawTerm(data), value) for data, value in self.sorted_map(item)]
+                    else:
+                        pairs = item.items()
+                    stack.append((itertools.chain.from_iterable(pairs), False))
+                    break
+                elif encoder is encode_tuple and not _LEAF_TYPES.issuperset(map(type, item)):
+                    n = len(item)
+                    if n < 256:
+                        buf += bytes([SMALL_TUPLE_EXT, n])
+                    else:
+                        buf.append(LARGE_TUPLE_EXT)
+                        buf += _pack_L(n)
+                    stack.append((iter(item), False))
+                    break
+                elif item.__class__ is bytes and len(item) >= chunk_size:
+                    buf.append(BINARY_EXT)
+                    buf += _pack_L(len(item))
+                    yield bytes(buf)
+                    del buf[:]
+                    yield item
                 else:
-                    return [bytes([LARGE_BIG_EXT]), struct.pack(">L", len(big_buf)), bytes([sign]), bytes(big_buf)]
-        elif isinstance(obj, float):
-            floatstr = ("%.20e" % obj).encode('ascii')
-            return [bytes([FLOAT_EXT]), floatstr + b"\x00"*(31-len(floatstr))]
-        elif isinstance(obj, Atom):
-            st = obj.encode('latin-1')
-            return [bytes([ATOM_EXT]), struct.pack(">H", len(st)), st]
-        elif isinstance(obj, str):
-            st = obj.encode('utf-8')
-            return [bytes([BINARY_EXT]), struct.pack(">L", len(st)), st]
-        elif isinstance(obj, bytes):
-            return [bytes([BINARY_EXT]), struct.pack(">L", len(obj)), obj]
-        elif isinstance(obj, tuple):
-            n = len(obj)
+                    encoder(item, buf)
+                    if len(buf) >= chunk_size:
+                        yield bytes(buf)
+                        del buf[:]
+            else:
+                stack.pop()
+                if is_list:
+                    buf.append(NIL_EXT)
+        if buf:
+            yield bytes(buf)
+
+    def iterencode_compressed(self, obj, chunk_size, level):
+        size = sum(len(chunk) for chunk in self.iterencode_chunks(obj, chunk_size)) - 1
+        if size > 0xffffffff:
+            raise EncodingError("Term of %d bytes too large to be compressed" % size)
+        yield bytes([FORMAT_VERSION, COMPRESSED]) + _pack_L(size)
+        compressor = zlib.compressobj(level)
+        chunks = self.iterencode_chunks(obj, chunk_size)
+        # Without the version byte
+        data = compressor.compress(memoryview(next(chunks))[1:])
+        for chunk in chunks:
+            if data:
+                yield data
+            data = compressor.compress(chunk)
+        yield data + compressor.flush()
+
+    def dump(self, obj, fileobj, chunk_size=65536, compressed=False):
+        """Encode obj into the binary file fileobj chunk by chunk (see
+        iterencode) and return the number of bytes written"""
+        written = 0
+        for chunk in self.iterencode(obj, chunk_size, compressed):
+            fileobj.write(chunk)
+            written += len(chunk)
+        return written
+
+    def encode_part(self, obj, buf):
+        encoder = self.encoders.get(obj.__class__)
+        if encoder is None:
+            encoder = self.find_encoder(obj)
+        encoder(obj, buf)
+
+    def find_encoder(self, obj):
+        cls = obj.__class__
+        for base in cls.__mro__[1:]:
+            encoder = self.encoders.get(base)
+            if encoder is not None:
+                self.encoders[cls] = encoder
+                return encoder
+        raise NotImplementedError("Unable to serialize %r" % obj)
+
+    def cached_encoder(self, encoder):
+        cache = self.cache
+        def encode_cached(obj, buf):
+            data = cache.get(obj)
+            if data is None:
+                start = len(buf)
+                encoder(obj, buf)
+                cache[obj] = bytes(buf[start:])
+            else:
+                buf += data
+        return encode_cached
+
+    def cached_tuple_encoder(self, encoder):
+        encode_cached = self.cached_encoder(encoder)
+        def encode_tuple(obj, buf):
+            # Only tuples of a few atoms and integers are cached. Their
+            # equality is that of their encoding, unlike with booleans
+            # (True == 1) or strings (Atom("a") == "a").
+            if len(obj) <= 8:
+                for item in obj:
+                    cls = item.__class__
+                    if cls is not Atom and cls is not int:
+                        break
+                else:
+                    return encode_cached(obj, buf)
+            encoder(obj, buf)
+        return encode_tuple
+
+    def register_record(self, tag, cls, fields=None, types=None):
+        """Encode the instances of cls, a dataclass or class with __slots__,
+        as tuples of the atom tag followed by the given fields.
+
+        fields and types default as for ErlangTermDecoder.register_record.
+        The encoder function generated for the record encodes the fields
+        whose value is of their annotated type (int, float, Atom, bytes or
+        str) without looking up their encoder.
+        """
+        fields, types = _record_schema(cls, fields, types)
+        lines = ["def encode_record(obj, buf):", "    buf += header"]
+        namespace = {}
+        for i, (name, t) in enumerate(zip(fields, types)):
+            lines.append("    value = obj.%s" % name)
+            if t is None:
+                lines.append("    encode_part(value, buf)")
+            else:
+                lines += ["    if value.__class__ is t%d:" % i,
+                          "        e%d(value, buf)" % i,
+                          "    else:",
+                          "        encode_part(value, buf)"]
+                namespace["t%d" % i] = t
+                namespace["e%d" % i] = self.encoders[t]
+        header = bytes([SMALL_TUPLE_EXT, len(fields) + 1]) + self.new_atom(Atom(tag))
+        self.encoders[cls] = _compile("encode_record", lines, header=header,
+                                      encode_part=self.encode_part, **namespace)
+
+    def encode_raw(self, obj, buf):
+        buf += obj.data
+
+    def encode_bool(self, obj, buf):
+        buf += self.true if obj else self.false
+
+    def encode_none(self, obj, buf):
+        buf += self.none
+
+    def encode_int(self, obj, buf):
+        if 0 <= obj <= 255:
+            buf += _SMALL_INTEGERS[obj]
+        elif -2147483648 <= obj <= 2147483647:
+            buf.append(INTEGER_EXT)
+            buf += _pack_l(obj)
+        else:
+            sign = obj < 0
+            obj = abs(obj)
+            n = (obj.bit_length() + 7) // 8
             if n < 256:
-                buf = [bytes([SMALL_TUPLE_EXT,n])]
+                buf += bytes([SMALL_BIG_EXT, n, sign])
             else:
-                buf = [bytes([LARGE_TUPLE_EXT]), struct.pack(">L", n)]
-            for item in obj:
-                buf += self.encode_part(item)
-            return buf
-        elif obj == []:
-            return [bytes([NIL_EXT])]
-        elif isinstance(obj, list):
-            buf = [bytes([LIST_EXT]), struct.pack(">L", len(obj))]
-            for item in obj:
-                buf += self.encode_part(item)
-            buf.append(bytes([NIL_EXT])) # list tail - no such thing in Python
-            return buf
-        elif isinstance(obj, Reference):
-            return [bytes([NEW_REFERENCE_EXT]),
-                struct.pack(">H", len(obj.ref_id)),
-                bytes([ATOM_EXT]), struct.pack(">H", len(obj.node)), obj.node.encode('latin-1'),
-                bytes([obj.creation]), struct.pack(">%dL" % len(obj.ref_id), *obj.ref_id)]
-        elif isinstance(obj, Port):
-            return [bytes([PORT_EXT]),
-                bytes([ATOM_EXT]), struct.pack(">H", len(obj.node)), obj.node.encode('latin-1'),
-                struct.pack(">LB", obj.port_id, obj.creation)]
-        elif isinstance(obj, PID):
-           return [bytes([PID_EXT]),
-                bytes([ATOM_EXT]), struct.pack(">H", len(obj.node)), obj.node.encode('latin-1'),
-                struct.pack(">LLB", obj.pid_id, obj.serial, obj.creation)]
-        elif isinstance(obj, Export):
-            return [bytes([EXPORT_EXT]),
-                bytes([ATOM_EXT]), struct.pack(">H", len(obj.module)), obj.module.encode('latin-1'),
-                bytes([ATOM_EXT]), struct.pack(">H", len(obj.function)), obj.function.encode('latin-1'),
-                bytes([SMALL_INTEGER_EXT,obj.arity])]
+                buf.append(LARGE_BIG_EXT)
+                buf += _pack_L(n)
+                buf.append(sign)
+            buf += obj.to_bytes(n, 'little')
+
+    def encode_float(self, obj, buf):
+        floatstr = ("%.20e" % obj).encode('ascii')
+        buf.append(FLOAT_EXT)
+        buf += floatstr
+        buf += b"\x00"*(31-len(floatstr))
+
+    def encode_new_float(self, obj, buf):
+        buf.append(NEW_FLOAT_EXT)
+        buf += _pack_d(obj)
+
+    def encode_atom(self, obj, buf):
+        cache = self.atom_cache
+        if cache is not None:
+            data = cache.get(obj)
+            if data is None:
+                data = cache[obj] = self.new_atom(obj)
+            buf += data
         else:
+            buf += self.new_atom(obj)
+
+    def new_atom(self, obj):
+        if self.profile == "modern":
+            st = obj.encode('utf-8')
+            if len(st) < 256:
+                return bytes([SMALL_ATOM_UTF8_EXT, len(st)]) + st
+            return bytes([ATOM_UTF8_EXT]) + _pack_H(len(st)) + st
+        st = obj.encode('latin-1')
+        return bytes([ATOM_EXT]) + _pack_H(len(st)) + st
+
+    def encode_str(self, obj, buf):
+        st = obj.encode('utf-8')
+        buf.append(BINARY_EXT)
+        buf += _pack_L(len(st))
+        buf += st
+
+    def encode_bytes(self, obj, buf):
+        buf.append(BINARY_EXT)
+        buf += _pack_L(len(obj))
+        buf += obj
+
+    def encode_tuple(self, obj, buf):
+        n = len(obj)
+        if n < 256:
+            buf += bytes([SMALL_TUPLE_EXT, n])
+        else:
+            buf.append(LARGE_TUPLE_EXT)
+            buf += _pack_L(n)
+        encoders = self.encoders
+        for item in obj:
+            encoder = encoders.get(item.__class__)
+            if encoder is None:
+                encoder = self.find_encoder(item)
+            encoder(item, buf)
+
+    def encode_list(self, obj, buf):
+        if not obj:
+            buf.append(NIL_EXT)
+            return
+        buf.append(LIST_EXT)
+        buf += _pack_L(len(obj))
+        encoders = self.encoders
+        for item in obj:
+            encoder = encoders.get(item.__class__)
+            if encoder is None:
+                encoder = self.find_encoder(item)
+            encoder(item, buf)
+        buf.append(NIL_EXT) # list tail - no such thing in Python
+
+    def encode_map(self, obj, buf):
+        buf.append(MAP_EXT)
+        buf += _pack_L(len(obj))
+        encoders = self.encoders
+        if self.sort_map_keys:
+            for data, value in self.sorted_map(obj):
+                buf += data
+                encoder = encoders.get(value.__class__)
+                if encoder is None:
+                    encoder = self.find_encoder(value)
+                encoder(value, buf)
+            return
+        for item in obj.items():
+            for term in item:
+                encoder = encoders.get(term.__class__)
+                if encoder is None:
+                    encoder = self.find_encoder(term)
+                encoder(term, buf)
+
+    def sorted_map(self, obj):
+        """Return the (encoded key, value) pairs of obj sorted by key"""
+        cache = self.atom_cache
+        pairs = []
+        for key, value in obj.items():
+            cls = key.__class__
+            if cls is Atom and cache is not None:
+                data = cache.get(key)
+                if data is None:
+                    data = cache[key] = self.new_atom(key)
+            elif cls is bytes:
+                data = b"m" + _pack_L(len(key)) + key
+            else:
+                data = bytearray()
+                self.encode_part(key, data)
+                data = bytes(data)
+            pairs.append((data, value))
+        pairs.sort(key=_first)
+        return pairs
+
+    def encode_array(self, obj, buf):
+        """Encode an array.array as a list, packed into a STRING_EXT or a
+        LIST_EXT of INTEGER_EXT or NEW_FLOAT_EXT elements in a few strided
+        copies when its elements allow it"""
+        typecode = obj.typecode
+        if not obj:
+            buf.append(NIL_EXT)
+        elif typecode == 'f' or typecode == 'd':
+            self.encode_packed(NEW_FLOAT_EXT, _big_endian(obj, 'd'), 8, len(obj), buf)
+        elif typecode not in _INT_TYPECODES:
             raise NotImplementedError("Unable to serialize %r" % obj)
+        elif len(obj) <= 65535 and 0 <= min(obj) and max(obj) <= 255:
+            buf.append(STRING_EXT)
+            buf += _pack_H(len(obj))
+            buf += obj.tobytes() if typecode == 'B' else array.array('B', obj).tobytes()
+        else:
+            try:
+                data = _big_endian(obj, 'i')
+            except OverflowError:
+                self.encode_list(obj.tolist(), buf)
+            else:
+                self.encode_packed(INTEGER_EXT, data, 4, len(obj), buf)
+
+    def encode_memoryview(self, obj, buf):
+        if obj.format in ('B', 'b', 'c'):
+            buf.append(BINARY_EXT)
+            buf += _pack_L(obj.nbytes)
+            buf += obj if obj.c_contiguous else obj.tobytes()
+        elif obj.ndim == 1 and obj.format in _ARRAY_TYPECODES:
+            values = array.array(obj.format)
+            values.frombytes(obj.tobytes())
+            self.encode_array(values, buf)
+        else:
+            self.encode_list(obj.tolist(), buf)
+
+    def encode_ndarray(self, obj, buf):
+        """Encode a one-dimensional numpy array of numbers as a list,
+        packed like an array.array"""
+        kind = obj.dtype.kind
+        if obj.ndim != 1 or kind not in "iuf":
+            self.encode_part(obj.tolist(), buf)
+        elif not len(obj):
+            buf.append(NIL_EXT)
+        elif kind == "f":
+            self.encode_packed(NEW_FLOAT_EXT, obj.astype(">f8").tobytes(), 8, len(obj), buf)
+        elif 0 <= obj.min() and obj.max() <= 255 and len(obj) <= 65535:
+            buf.append(STRING_EXT)
+            buf += _pack_H(len(obj))
+            buf += obj.astype("u1").tobytes()
+        elif -2147483648 <= obj.min() and obj.max() <= 2147483647:
+            self.encode_packed(INTEGER_EXT, obj.astype(">i4").tobytes(), 4, len(obj), buf)
+        else:
+            self.encode_list(obj.tolist(), buf)
+
+    def encode_packed(self, tag, data, width, n, buf):
+        """Encode a list of n elements of the given tag from data, their
+        big-endian values of width bytes each, back to back"""
+        size = width + 1
+        buf.append(LIST_EXT)
+        buf += _pack_L(n)
+        start = len(buf)
+        end = start + size * n
+        buf += bytes(size * n)
+        buf[start:end:size] = bytes([tag]) * n
+        for i in range(width):
+            buf[start+1+i:end:size] = data[i::width]
+        buf.append(NIL_EXT)
+
+    def encode_reference(self, obj, buf):
+        buf.append(NEW_REFERENCE_EXT)
+        buf += _pack_H(len(obj.ref_id))
+        self.encode_atom(obj.node, buf)
+        buf.append(obj.creation)
+        buf += struct.pack(">%dL" % len(obj.ref_id), *obj.ref_id)
+
+    def encode_port(self, obj, buf):
+        buf.append(PORT_EXT)
+        self.encode_atom(obj.node, buf)
+        buf += struct.pack(">LB", obj.port_id, obj.creation)
+
+    def encode_pid(self, obj, buf):
+        buf.append(PID_EXT)
+        self.encode_atom(obj.node, buf)
+        buf += struct.pack(">LLB", obj.pid_id, obj.serial, obj.creation)
+
+    def encode_newer_reference(self, obj, buf):
+        buf.append(NEWER_REFERENCE_EXT)
+        buf += _pack_H(len(obj.ref_id))
+        self.encode_atom(obj.node, buf)
+        buf += struct.pack(">%dL" % (len(obj.ref_id) + 1), obj.creation, *obj.ref_id)
+
+    def encode_new_port(self, obj, buf):
+        if obj.port_id > 0xffffffff:
+            buf.append(V4_PORT_EXT)
+            self.encode_atom(obj.node, buf)
+            buf += struct.pack(">QL", obj.port_id, obj.creation)
+        else:
+            buf.append(NEW_PORT_EXT)
+            self.encode_atom(obj.node, buf)
+            buf += struct.pack(">LL", obj.port_id, obj.creation)
+
+    def encode_new_pid(self, obj, buf):
+        buf.append(NEW_PID_EXT)
+        self.encode_atom(obj.node, buf)
+        buf += struct.pack(">LLL", obj.pid_id, obj.serial, obj.creation)
+
+    def encode_export(self, obj, buf):
+        buf.append(EXPORT_EXT)
+        self.encode_atom(obj.module, buf)
+        self.encode_atom(obj.function, buf)
+        buf += bytes([SMALL_INTEGER_EXT, obj.arity])
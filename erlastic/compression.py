@@ -0,0 +1,95 @@
+"""Policies deciding when and how hard to compress encoded terms"""
+
+import time
+import zlib
+
+__all__ = ["CompressionPolicy", "CompressionStats"]
+
+# Number of slices, spread over the data, the sample is made of
+_SAMPLE_SLICES = 4
+
+class CompressionStats(object):
+    def __init__(self):
+        # Terms submitted, and those compressed or skipped as too small or
+        # incompressible
+        self.terms = 0
+        self.compressed = 0
+        self.too_small = 0
+        self.incompressible = 0
+        # Size of the terms submitted, and of what was sent in their stead
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Time spent compressing, samples included
+        self.seconds = 0.0
+
+    @property
+    def ratio(self):
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+    def __repr__(self):
+        return "CompressionStats(%s)" % ", ".join("%s=%r" % item for item in sorted(self.__dict__.items()))
+
+class CompressionPolicy(object):
+    """Compress the terms worth it, at a level depending on their size.
+
+    Terms smaller than threshold bytes are left alone. For terms more than
+    twice as large as sample_size, that many bytes sampled across the term
+    are compressed first: if they don't shrink below max_ratio of their
+    size, such as with already compressed binaries, neither would the term
+    and it is left alone. The others are compressed at the level of the
+    last (size, level) of levels whose size they reach, and only kept
+    compressed if that makes them smaller.
+
+    stats accumulates the bytes in and out and the time spent.
+    """
+
+    def __init__(self, threshold=1024, sample_size=4096, max_ratio=0.9,
+                 levels=((0, 6), (1 << 16, 3), (1 << 20, 1))):
+        self.threshold = threshold
+        self.sample_size = sample_size
+        self.max_ratio = max_ratio
+        self.levels = sorted(levels)
+        self.stats = CompressionStats()
+
+    def level(self, size):
+        result = self.levels[0][1]
+        for min_size, level in self.levels:
+            if size < min_size:
+                break
+            result = level
+        return result
+
+    def estimate(self, data):
+        """Return the ratio of compressed to original size of a sample of data"""
+        step = len(data) // _SAMPLE_SLICES
+        width = self.sample_size // _SAMPLE_SLICES
+        sample = b"".join([data[i*step:i*step+width] for i in range(_SAMPLE_SLICES)])
+        return len(zlib.compress(sample, 1)) / len(sample)
+
+    def compress(self, data):
+        """Return data (a term without its version byte) compressed, or None
+        if it isn't worth it"""
+        size = len(data)
+        stats = self.stats
+        stats.terms += 1
+        stats.bytes_in += size
+        if size < self.threshold:
+            stats.too_small += 1
+            stats.bytes_out += size
+            return None
+        start = time.perf_counter()
+        try:
+            if size > 2 * self.sample_size and self.estimate(data) > self.max_ratio:
+                compressed = None
+            else:
+                compressed = zlib.compress(data, self.level(size))
+        finally:
+            stats.seconds += time.perf_counter() - start
+        # The compressed term has a tag and the size of the data in front
+        if compressed is None or len(compressed) + 5 >= size:
+            stats.incompressible += 1
+            stats.bytes_out += size
+            return None
+        stats.compressed += 1
+        stats.bytes_out += len(compressed) + 5
+        return compressed
@@ -22,5 +22,12 @@ NEW_FUN_EXT = 112       # [UInt32:Size, UInt8:Arity, 16*Uint6-MD5:Uniq, UInt32:I
 EXPORT_EXT = 113        # [atom:Module, atom:Function, smallint:Arity]
 NEW_REFERENCE_EXT = 114 # [UInt16:Len, atom:Node, UInt8:Creation, Len*UInt32:ID]
 SMALL_ATOM_EXT = 115    # [UInt8:Len, Len:AtomName]
+MAP_EXT = 116           # [UInt32:Arity, N:Pairs]
 FUN_EXT = 117           # [UInt4:NumFree, pid:Pid, atom:Module, int:Index, int:Uniq, NumFree*ext:FreeVars]
+ATOM_UTF8_EXT = 118     # [UInt16:Len, Len:AtomName] UTF-8 encoded
+SMALL_ATOM_UTF8_EXT = 119 # [UInt8:Len, Len:AtomName] UTF-8 encoded
+NEW_PID_EXT = 88        # [atom:Node, UInt32:ID, UInt32:Serial, UInt32:Creation]
+NEW_PORT_EXT = 89       # [atom:Node, UInt32:ID, UInt32:Creation]
+NEWER_REFERENCE_EXT = 90 # [UInt16:Len, atom:Node, UInt32:Creation, Len*UInt32:ID]
+V4_PORT_EXT = 120       # [atom:Node, UInt64:ID, UInt32:Creation]
 COMPRESSED = 80         # [UInt4:UncompressedSize, N:ZlibCompressedData]
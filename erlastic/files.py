@@ -0,0 +1,347 @@
+"""Random access to files of terms through a persistent offset index"""
+
+import array
+import concurrent.futures
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+from erlastic.codec import EncodingError, ErlangTermDecoder, ErlangTermEncoder, LazyTerm
+from erlastic.constants import FORMAT_VERSION
+from erlastic.stream import _HEADERS, encode_frame
+
+__all__ = ["TermFileReader", "TermFileWriter"]
+
+# An index file starts with this magic, the packet size of the file it
+# indexes and the fingerprint of its first term, in 16 bytes, followed by
+# 64-bit big-endian offsets: the start of every term (or of its packet
+# header) and the end of the last one
+_INDEX_MAGIC = b"ETFIDX02"
+_INDEX_HEADER = struct.Struct(">8sB3xL")
+
+def _fingerprint(buf, end):
+    """Return the CRC-32 of the first term of a file (or of its first 4KB),
+    ending at end, which appending to the file doesn't change"""
+    return zlib.crc32(buf[:min(end, 4096)])
+
+def _to_big_endian(offsets):
+    if sys.byteorder == 'little':
+        offsets = array.array('Q', offsets)
+        offsets.byteswap()
+    return offsets.tobytes()
+
+def _write_index(path, packet, fingerprint, *offsets):
+    """Write a whole index file, through a temporary file renamed over it so
+    that readers never load it half written"""
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, packet, fingerprint))
+            for chunk in offsets:
+                f.write(_to_big_endian(chunk))
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def _index_path(path, index):
+    if index is True:
+        return path + ".idx"
+    return index or None
+
+def _open_map(f):
+    """Return a read-only mmap of the file f, or empty bytes as empty files
+    can't be mapped"""
+    if os.fstat(f.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _map_range(path, packet, offsets, func):
+    """Return func applied to the terms of the file at path starting at
+    offsets, run in the workers of TermFileReader.map"""
+    decoder = ErlangTermDecoder()
+    with open(path, "rb") as f:
+        buf = _open_map(f)
+        try:
+            return [func(decoder.decode(buf, offset + packet)) for offset in offsets]
+        finally:
+            if buf:
+                buf.close()
+
+class TermFileReader(object):
+    """Decode the terms of a file in place through a memory map.
+
+    The file is made of terms with a packet header of the given size, as
+    written by a {packet, N} port or TermFileWriter, or of terms written
+    back to back (packet=0), as term_to_binary dumps. Their offsets are
+    indexed on opening, and the index saved (by default to the path of the
+    file followed by ".idx") so that later readers only need to index the
+    terms appended since. If it can't be saved, as in a read-only
+    directory, the index is only kept in memory. An incomplete term at the
+    end of the file is left out.
+
+    reader[i] decodes the i-th term, reader[i:j] the terms in that range,
+    lazy(i) returns it as a LazyTerm and frame(i) still encoded. map()
+    applies a function to ranges of terms in a pool of workers.
+    """
+
+    def __init__(self, path, packet=4, decoder=None, index=True):
+        if packet not in (0, 1, 2, 4):
+            raise ValueError("packet must be 0, 1, 2 or 4")
+        self.path = path
+        self.packet = packet
+        self.decoder = decoder or ErlangTermDecoder()
+        self.index_path = _index_path(path, index)
+        self.file = open(path, "rb")
+        self.buf = _open_map(self.file)
+        self.view = memoryview(self.buf)
+        # Number of offsets read from the index file
+        self.saved = 0
+        self.offsets = self.load_index()
+        self.update_index()
+        if self.index_path and len(self.offsets) != self.saved:
+            try:
+                self.save_index(self.saved)
+            except OSError:
+                # Such as a read-only directory: the index is kept in memory
+                pass
+
+    def load_index(self):
+        """Return the offsets saved in the index file, if any and valid"""
+        offsets = array.array('Q', [0])
+        if not self.index_path or not os.path.exists(self.index_path):
+            return offsets
+        with open(self.index_path, "rb") as f:
+            data = f.read()
+        if len(data) < _INDEX_HEADER.size + 8:
+            return offsets
+        magic, packet, fingerprint = _INDEX_HEADER.unpack_from(data)
+        if (magic, packet) != (_INDEX_MAGIC, self.packet):
+            return offsets
+        saved = array.array('Q')
+        size = len(data) - _INDEX_HEADER.size
+        saved.frombytes(data[_INDEX_HEADER.size:_INDEX_HEADER.size + size - size % 8])
+        if sys.byteorder == 'little':
+            saved.byteswap()
+        if not self.indexes(saved, fingerprint):
+            # Indexes a different file, or an earlier version of this one
+            return offsets
+        self.saved = len(saved)
+        return saved
+
+    def indexes(self, saved, fingerprint):
+        """Tell whether the saved offsets are those of this file: it starts
+        with the term the index was made for, and a sample of up to 64 of
+        the indexed terms, the last one included, still span the offsets
+        saved for them"""
+        if len(saved) == 1:
+            return True
+        buf = self.buf
+        if saved[-1] > len(buf) or _fingerprint(buf, saved[1]) != fingerprint:
+            return False
+        packet = self.packet
+        count = len(saved) - 1
+        for i in sorted(set(range(0, count, -(-count // 64))) | {count - 1}):
+            start, end = saved[i], saved[i + 1]
+            if packet:
+                if end - start < packet or _HEADERS[packet].unpack_from(buf, start)[0] != end - start - packet:
+                    return False
+            else:
+                try:
+                    if buf[start] != FORMAT_VERSION or self.decoder.scan(buf, start + 1, compressed=True) != (end, 0):
+                        return False
+                except (EncodingError, zlib.error):
+                    return False
+        return True
+
+    def update_index(self):
+        """Index the terms found after the last indexed one"""
+        buf = self.buf
+        size = len(buf)
+        offsets = self.offsets
+        pos = offsets[-1]
+        packet = self.packet
+        if packet:
+            header = _HEADERS[packet]
+            while pos + packet <= size:
+                end = pos + packet + header.unpack_from(buf, pos)[0]
+                if end > size:
+                    break
+                offsets.append(end)
+                pos = end
+        else:
+            scan = self.decoder.scan
+            while pos < size:
+                if buf[pos] != FORMAT_VERSION:
+                    raise ValueError("Bad version number %d at offset %d of %s" % (buf[pos], pos, self.path))
+                end, pending = scan(buf, pos + 1, compressed=True)
+                if pending:
+                    break
+                offsets.append(end)
+                pos = end
+
+    def save_index(self, saved=0):
+        """Save the index, appending to the index file from the saved-th
+        offset on if it already holds the ones before, the first term's
+        included"""
+        if saved > 1:
+            with open(self.index_path, "r+b") as f:
+                f.seek(_INDEX_HEADER.size + 8 * saved)
+                f.write(_to_big_endian(self.offsets[saved:]))
+        else:
+            offsets = self.offsets
+            fingerprint = _fingerprint(self.buf, offsets[1]) if len(offsets) > 1 else 0
+            _write_index(self.index_path, self.packet, fingerprint, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def span(self, index):
+        """Return the start and end offsets of the index-th term, version
+        byte included"""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Term index out of range")
+        return self.offsets[index] + self.packet, self.offsets[index + 1]
+
+    def frame(self, index):
+        """Return the index-th term encoded, as a memoryview of the file"""
+        start, end = self.span(index)
+        return self.view[start:end]
+
+    def lazy(self, index):
+        return LazyTerm(self.frame(index), decoder=self.decoder)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.iterate(range(*index.indices(len(self)))))
+        return self.decoder.decode(self.frame(index))
+
+    def __iter__(self):
+        return self.iterate(range(len(self)))
+
+    def iterate(self, indices):
+        decode = self.decoder.decode
+        view, offsets, packet = self.view, self.offsets, self.packet
+        for i in indices:
+            yield decode(view[offsets[i] + packet:offsets[i + 1]])
+
+    def map(self, func, start=0, stop=None, executor="process", workers=None, chunk_size=None):
+        """Return an iterator over func applied to the terms from start to
+        stop, in order.
+
+        The range is split in chunks of chunk_size terms handed to a pool of
+        workers, which map the file themselves and decode the terms with a
+        default ErlangTermDecoder. executor is "process" (func must then be
+        picklable), "thread" or a concurrent.futures.Executor.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        workers = workers or os.cpu_count() or 1
+        if chunk_size is None:
+            chunk_size = max(1, -(-(stop - start) // (4 * workers)))
+        owned = isinstance(executor, str)
+        if executor == "process":
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        elif executor == "thread":
+            executor = concurrent.futures.ThreadPoolExecutor(workers)
+        return self.map_chunks(executor, owned, func, start, stop, chunk_size)
+
+    def map_chunks(self, executor, owned, func, start, stop, chunk_size):
+        try:
+            futures = [executor.submit(_map_range, self.path, self.packet,
+                                       self.offsets[i:min(i + chunk_size, stop)], func)
+                       for i in range(start, stop, chunk_size)]
+            for future in futures:
+                for result in future.result():
+                    yield result
+        finally:
+            if owned:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    def close(self):
+        self.view.release()
+        if self.buf:
+            self.buf.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class TermFileWriter(object):
+    """Append terms to a file, with a packet header of the given size (or
+    back to back with packet=0), keeping its TermFileReader index up to date.
+
+    Terms are encoded into a buffer written out once it holds buffer_size
+    bytes, on flush() and on close(). The file is written before its index,
+    so that an interrupted write leaves at most terms missing from the
+    index, which readers then index themselves.
+    """
+
+    def __init__(self, path, packet=4, encoder=None, buffer_size=1 << 20, index=True):
+        if packet not in (0, 1, 2, 4):
+            raise ValueError("packet must be 0, 1, 2 or 4")
+        self.packet = packet
+        self.encoder = encoder or ErlangTermEncoder()
+        self.buffer_size = buffer_size
+        self.index_path = _index_path(path, index)
+        if os.path.exists(path):
+            # Bring the index up to date, and drop any incomplete term
+            # left at the end by an interrupted write
+            with TermFileReader(path, packet, index=index) as reader:
+                end = reader.offsets[-1]
+            with open(path, "r+b") as f:
+                f.truncate(end)
+        elif self.index_path:
+            _write_index(self.index_path, packet, 0, array.array('Q', [0]))
+        self.file = open(path, "ab")
+        self.end = self.file.tell()
+        self.buffer = bytearray()
+        # End offsets of the buffered terms
+        self.ends = array.array('Q')
+
+    def append(self, obj):
+        end = encode_frame(self.encoder, obj, self.buffer, self.packet)
+        self.ends.append(self.end + end)
+        if end >= self.buffer_size:
+            self.flush()
+
+    def extend(self, objs):
+        for obj in objs:
+            self.append(obj)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self.file.write(self.buffer)
+        self.file.flush()
+        if self.index_path:
+            if self.end:
+                with open(self.index_path, "ab") as f:
+                    f.write(_to_big_endian(self.ends))
+            else:
+                # The first terms of the file: the header needs their fingerprint
+                _write_index(self.index_path, self.packet, _fingerprint(self.buffer, self.ends[0]),
+                             array.array('Q', [0]), self.ends)
+        self.end += len(self.buffer)
+        self.buffer.clear()
+        del self.ends[:]
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,149 @@
+"""Opt-in profiling of the terms going through an encoder or decoder"""
+
+import functools
+import time
+
+from erlastic import constants
+from erlastic.codec import ErlangTermDecoder, ErlangTermEncoder
+
+__all__ = ["CodecStats", "instrument", "uninstrument"]
+
+TAG_NAMES = dict((value, name) for name, value in vars(constants).items()
+                 if name.endswith("_EXT") or name == "COMPRESSED")
+
+class CodecStats(object):
+    def __init__(self):
+        # Terms encoded or decoded, their size and the time it took
+        self.terms = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        # [count, bytes] of the values of each tag, by tag name, the bytes
+        # of the elements of tuples, lists and maps not included
+        self.tags = {}
+        # [calls, seconds] of the encode_*/decode_* handlers, by name. The
+        # time of the encoders of containers includes that of their elements.
+        self.handlers = {}
+
+    def report(self):
+        """Return the stats as a table, the most frequent tags and slowest
+        handlers called first"""
+        lines = ["%d terms, %d bytes, %.3f s" % (self.terms, self.bytes, self.seconds)]
+        lines.append("%-22s %10s %12s" % ("tag", "count", "bytes"))
+        for name, (count, size) in sorted(self.tags.items(), key=lambda item: -item[1][0]):
+            lines.append("%-22s %10d %12d" % (name, count, size))
+        lines.append("%-22s %10s %12s" % ("handler", "calls", "us/call"))
+        for name, (calls, seconds) in sorted(self.handlers.items(), key=lambda item: -item[1][1]):
+            if calls:
+                lines.append("%-22s %10d %12.3f" % (name, calls, seconds / calls * 1e6))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return "CodecStats(terms=%d, bytes=%d, seconds=%r)" % (self.terms, self.bytes, self.seconds)
+
+def count_tags(scanner, buf, offset, tags):
+    """Count the values of the term at offset in tags by tag and return the
+    offset just past its end. Compressed terms are counted as a whole."""
+    end = len(buf)
+    if buf[offset] == constants.COMPRESSED:
+        size = scanner.scan_compressed(buf, offset, end)
+        entry = tags.setdefault("COMPRESSED", [0, 0])
+        entry[0] += 1
+        entry[1] += size
+        return offset + size
+    pending = 1
+    while pending:
+        tag = buf[offset]
+        size, children = scanner.scan_term(buf, offset, tag, end)
+        entry = tags.get(TAG_NAMES.get(tag, tag))
+        if entry is None:
+            entry = tags[TAG_NAMES.get(tag, tag)] = [0, 0]
+        entry[0] += 1
+        entry[1] += size
+        offset += size
+        pending += children - 1
+    return offset
+
+def timed(func, entry):
+    clock = time.perf_counter
+    @functools.wraps(func)
+    def timed_handler(*args):
+        start = clock()
+        try:
+            return func(*args)
+        finally:
+            entry[0] += 1
+            entry[1] += clock() - start
+    return timed_handler
+
+def instrument(codec, stats=None):
+    """Count the terms encoded or decoded by codec, an ErlangTermEncoder or
+    ErlangTermDecoder, and time its handlers, in stats (a new CodecStats by
+    default), which is returned.
+
+    Terms are counted by encode() and encode_into(), or decode(), which
+    then walk each term a second time to count its tags. The tags decoded
+    inline by decode_part (integers, atoms, binaries and containers) have
+    no handler to time. Instrumentation is removed by uninstrument().
+    """
+    if getattr(codec, "instrumented", None) is not None:
+        raise ValueError("%r is already instrumented" % codec)
+    stats = stats or CodecStats()
+    clock = time.perf_counter
+    tags = stats.tags
+    if isinstance(codec, ErlangTermDecoder):
+        handlers = codec.decoders
+        names = dict((tag, TAG_NAMES.get(tag, handler.__name__)) for tag, handler in handlers.items())
+        decode = codec.decode
+        def instrumented_decode(buf, offset=0, raw=None):
+            start = clock()
+            result = decode(buf, offset, raw)
+            stats.seconds += clock() - start
+            stats.terms += 1
+            stats.bytes += count_tags(codec, buf, offset + 1, tags) - offset
+            return result
+        codec.decode = instrumented_decode
+    elif isinstance(codec, ErlangTermEncoder):
+        handlers = codec.encoders
+        names = dict((cls, getattr(handler, "__name__", cls.__name__)) for cls, handler in handlers.items())
+        scanner = ErlangTermDecoder(atom_cache=None)
+        encode, encode_into = codec.encode, codec.encode_into
+        def instrumented_encode(obj, compressed=None):
+            start = clock()
+            result = encode(obj, compressed)
+            stats.seconds += clock() - start
+            stats.terms += 1
+            stats.bytes += count_tags(scanner, result, 1, tags)
+            return result
+        def instrumented_encode_into(obj, buffer, offset=0):
+            start = clock()
+            end = encode_into(obj, buffer, offset)
+            stats.seconds += clock() - start
+            stats.terms += 1
+            stats.bytes += count_tags(scanner, buffer, offset + 1, tags) - offset
+            return end
+        codec.encode, codec.encode_into = instrumented_encode, instrumented_encode_into
+    else:
+        raise TypeError("Expected an ErlangTermEncoder or ErlangTermDecoder, got %r" % codec)
+    # Types sharing a handler (dict and FrozenMap) share its wrapper too
+    wrappers = {}
+    for key, handler in list(handlers.items()):
+        wrapper = wrappers.get(id(handler))
+        if wrapper is None:
+            entry = stats.handlers.setdefault(names[key], [0, 0.0])
+            wrapper = wrappers[id(handler)] = timed(handler, entry)
+        handlers[key] = wrapper
+    codec.instrumented = stats
+    return stats
+
+def uninstrument(codec):
+    """Remove the instrumentation of codec and return its stats"""
+    stats = getattr(codec, "instrumented", None)
+    if stats is None:
+        raise ValueError("%r is not instrumented" % codec)
+    handlers = codec.decoders if isinstance(codec, ErlangTermDecoder) else codec.encoders
+    for key, handler in list(handlers.items()):
+        # Including those copied for subclasses since
+        handlers[key] = getattr(handler, "__wrapped__", handler)
+    for name in ("decode", "encode", "encode_into", "instrumented"):
+        codec.__dict__.pop(name, None)
+    return stats
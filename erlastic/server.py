@@ -0,0 +1,133 @@
+"""Concurrent request handling for Python programs run as Erlang ports"""
+
+import collections
+import concurrent.futures
+import os
+import threading
+
+from erlastic import decode, encode, port_connection
+from erlastic.types import Atom
+
+__all__ = ["PortServer", "ServerStats"]
+
+def handle_frame(handler, tag, frame):
+    """Decode a request, handle it and return (failed, encoded reply).
+
+    Runs in the workers, so that with a process pool both decoding and
+    encoding happen outside of the main process. A request that can't be
+    decoded, or tagged, gets an untagged {error, Repr} reply: there is no
+    reference to send it with.
+    """
+    try:
+        request = decode(frame)
+        ref = tag(request) if tag is not None else None
+    except Exception as e:
+        return True, encode((Atom("error"), repr(e)))
+    try:
+        reply = handler(request)
+        failed = False
+    except Exception as e:
+        reply = (Atom("error"), repr(e))
+        failed = True
+    if tag is not None:
+        reply = (ref, reply)
+    return failed, encode(reply)
+
+class ServerStats(object):
+    def __init__(self):
+        self.received = 0
+        self.replied = 0
+        self.errors = 0
+        # Requests received and not replied to yet, and their peak number
+        self.queue_depth = 0
+        self.peak_queue_depth = 0
+
+    def __repr__(self):
+        return "ServerStats(%s)" % ", ".join("%s=%d" % item for item in sorted(self.__dict__.items()))
+
+class PortServer(object):
+    """Handle the requests of a port concurrently in a pool of workers.
+
+    handler is called with each request term and returns the reply term. If
+    it raises, the reply is {error, Repr} instead. executor is "thread",
+    "process" or a concurrent.futures.Executor; with a process pool the
+    handler (and tag) must be picklable, and the workers receive the raw
+    encoded requests.
+
+    Without tag, replies are sent in the order the requests arrived. tag is
+    a function returning a reference term (such as a Reference) from a
+    request: replies are then sent as {Ref, Reply} as soon as they are
+    ready, except for requests that can't be decoded or tagged, which get
+    an untagged {error, Repr}. At most max_in_flight requests (by default
+    twice the number of workers, itself defaulting to the number of CPUs)
+    are handled at a time; reading from the port pauses meanwhile.
+    """
+
+    def __init__(self, handler, executor="thread", workers=None, max_in_flight=None,
+                 tag=None, mailbox=None, port=None):
+        workers = workers or os.cpu_count() or 1
+        if executor == "thread":
+            executor = concurrent.futures.ThreadPoolExecutor(workers)
+        elif executor == "process":
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        if mailbox is None:
+            mailbox, port = port_connection(raw=True)
+        self.handler = handler
+        self.executor = executor
+        self.tag = tag
+        self.mailbox = mailbox
+        self.port = port
+        self.slots = threading.BoundedSemaphore(max_in_flight or 2 * workers)
+        self.lock = threading.Lock()
+        # Requests whose replies haven't been sent yet, in arrival order
+        self.pending = collections.deque()
+        self.stats = ServerStats()
+
+    def serve(self):
+        """Handle requests until the port is closed and every reply has been sent"""
+        stats = self.stats
+        try:
+            for frame in self.mailbox:
+                self.slots.acquire()
+                future = self.executor.submit(handle_frame, self.handler, self.tag, frame)
+                with self.lock:
+                    stats.received += 1
+                    stats.queue_depth += 1
+                    stats.peak_queue_depth = max(stats.peak_queue_depth, stats.queue_depth)
+                    if self.tag is None:
+                        self.pending.append(future)
+                future.add_done_callback(self.completed)
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def completed(self, future):
+        with self.lock:
+            if self.tag is not None:
+                self.reply(future)
+                return
+            pending = self.pending
+            error = None
+            while pending and pending[0].done():
+                try:
+                    self.reply(pending.popleft())
+                except Exception as e:
+                    # Don't leave the replies queued behind unsent
+                    error = error or e
+            if error is not None:
+                raise error
+
+    def reply(self, future):
+        try:
+            failed, frame = future.result()
+        except Exception as e:
+            # The request couldn't be handed to a worker
+            failed, frame = True, encode((Atom("error"), repr(e)))
+        try:
+            self.port.send(frame)
+            self.stats.replied += 1
+        finally:
+            # Even if the port is gone, so that serve() doesn't wait for
+            # a slot forever
+            self.stats.errors += failed
+            self.stats.queue_depth -= 1
+            self.slots.release()
@@ -0,0 +1,141 @@
+"""Incremental decoding of terms received in arbitrary chunks"""
+
+import struct
+
+from erlastic.codec import ErlangTermDecoder, EncodingError, DecodeLimitError
+from erlastic.constants import FORMAT_VERSION
+
+__all__ = ["TermStreamDecoder"]
+
+_HEADERS = {1: struct.Struct(">B"), 2: struct.Struct(">H"), 4: struct.Struct(">L")}
+
+def encode_frame(encoder, obj, buf, packet):
+    """Append obj to the bytearray buf, encoded by encoder behind a header
+    of packet bytes holding its size (none with packet=0), and return the
+    offset just past its end. buf is left as it was if obj can't be
+    encoded or is too large for the header."""
+    start = len(buf)
+    try:
+        # encode_into pads buf up to the offset, leaving room for the header
+        end = encoder.encode_into(obj, buf, start + packet)
+        if packet:
+            length = end - start - packet
+            if length >> (8 * packet):
+                raise ValueError("Term of %d bytes too large for {packet,%d}" % (length, packet))
+            _HEADERS[packet].pack_into(buf, start, length)
+    except:
+        del buf[start:]
+        raise
+    return end
+
+class TermStreamDecoder(object):
+    """Decode the terms of a byte stream fed in chunks of any size.
+
+    packet is the size of the length header in front of every term, as with
+    the {packet, N} option of an Erlang port or gen_tcp socket, or 0 for
+    terms (as produced by term_to_binary) written back to back. In the
+    latter case the end of a term is found by scanning it, which resumes
+    where it stopped when more data comes in.
+
+    Consumed data is discarded from the internal buffer once it makes up at
+    least half of it, so the cost of buffering is amortized linear in the
+    size of the stream. If the decoder has limits with a max_size, frames
+    are rejected as soon as they are known to exceed it, rather than
+    buffered.
+    """
+
+    def __init__(self, packet=4, decoder=None):
+        if packet not in (0, 1, 2, 4):
+            raise ValueError("packet must be 0, 1, 2 or 4")
+        self.packet = packet
+        self.decoder = decoder or ErlangTermDecoder()
+        self.buffer = bytearray()
+        # Start of the first frame not returned yet
+        self.pos = 0
+        # Scan state of the term at pos for unframed streams
+        self.scanned = None
+        self.pending = 0
+
+    def __len__(self):
+        """Number of bytes buffered that aren't part of a returned term"""
+        return len(self.buffer) - self.pos
+
+    def feed(self, data):
+        """Buffer data and return the list of terms it completes"""
+        terms = []
+        for start, end in self.frames(data):
+            terms.append(self.decode_frame(start, end))
+        self.compact()
+        return terms
+
+    def feed_frames(self, data):
+        """Buffer data and return the list of encoded terms it completes,
+        each as bytes starting with the version byte"""
+        frames = [bytes(self.buffer[start:end]) for start, end in self.frames(data)]
+        self.compact()
+        return frames
+
+    def frames(self, data):
+        buf = self.buffer
+        buf += data
+        packet = self.packet
+        limits = self.decoder.limits
+        max_size = limits.max_size if limits is not None else None
+        while True:
+            pos = self.pos
+            if packet:
+                start = pos + packet
+                if len(buf) < start:
+                    return
+                end = start + _HEADERS[packet].unpack_from(buf, pos)[0]
+                if end - start < 2:
+                    # Not even a version byte and a tag
+                    raise EncodingError("Frame of %d bytes too short for a term" % (end - start))
+                if max_size is not None and end - start > max_size:
+                    raise DecodeLimitError("Frame of %d bytes exceeds the limit of %d" % (end - start, max_size))
+                if len(buf) < end:
+                    return
+            else:
+                start = pos
+                if self.scanned is None:
+                    if len(buf) <= pos:
+                        return
+                    if buf[pos] != FORMAT_VERSION:
+                        raise EncodingError("Bad version number. Expected %d found %d" % (FORMAT_VERSION, buf[pos]))
+                    self.scanned, self.pending = pos + 1, 1
+                # Only the whole term, right after the version byte, may be compressed
+                compressed = self.scanned == pos + 1
+                self.scanned, self.pending = self.decoder.scan(buf, self.scanned, self.pending, compressed)
+                if self.pending:
+                    if max_size is not None and len(buf) - pos > max_size:
+                        raise DecodeLimitError("Term of more than %d bytes" % max_size)
+                    return
+                end = self.scanned
+                self.scanned = None
+            self.pos = end
+            yield start, end
+
+    def decode_frame(self, start, end):
+        if self.decoder.borrow_binaries:
+            # Borrowed binaries must not pin the buffer
+            return self.decoder.decode(bytes(self.buffer[start:end]))
+        try:
+            with memoryview(self.buffer) as view:
+                return self.decoder.decode(view[start:end])
+        except Exception:
+            # The traceback may hold views of the buffer, which would make
+            # it impossible to resize: carry on with a copy
+            self.buffer = bytearray(self.buffer)
+            raise
+
+    def compact(self):
+        pos = self.pos
+        if pos == len(self.buffer):
+            self.buffer.clear()
+        elif pos < len(self.buffer) // 2:
+            return
+        else:
+            del self.buffer[:pos]
+            if self.scanned is not None:
+                self.scanned -= pos
+        self.pos = 0
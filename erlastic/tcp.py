@@ -0,0 +1,304 @@
+"""Exchanging terms with Erlang gen_tcp sockets opened with {packet, N}"""
+
+import collections
+import os
+import queue
+import socket
+import threading
+
+from erlastic.codec import ErlangTermEncoder, EncodingError
+from erlastic.stream import _HEADERS, TermStreamDecoder, encode_frame
+from erlastic.types import Atom
+
+__all__ = ["TermConnection", "TermClient", "TermServer", "call"]
+
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 1024
+
+def sendmsg_all(sock, buffers):
+    """Send every buffer with as few sendmsg calls as possible"""
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    buffers = [memoryview(buf).cast("B") for buf in buffers]
+    i = 0
+    while i < len(buffers):
+        sent = sock.sendmsg(buffers[i:i + _IOV_MAX])
+        # Skip what was sent, resuming in the middle of a partly sent buffer
+        while sent and sent >= len(buffers[i]):
+            sent -= len(buffers[i])
+            i += 1
+        if sent:
+            buffers[i] = buffers[i][sent:]
+        while i < len(buffers) and not len(buffers[i]):
+            i += 1
+
+class TermConnection(object):
+    """Exchange terms over a connected socket, with the packet header of a
+    gen_tcp socket opened with {packet, N} (or none with packet=0).
+
+    Data is received with recv_into into a reusable chunk_size buffer.
+    Terms are encoded into a reusable buffer behind room left for their
+    header, several of them going out in a single write with send_many().
+    Already encoded terms are sent by send_frames() with scatter-gather
+    writes of their headers and data.
+    """
+
+    def __init__(self, sock, packet=4, encoder=None, decoder=None, chunk_size=65536):
+        if packet not in (0, 1, 2, 4):
+            raise ValueError("packet must be 0, 1, 2 or 4")
+        self.socket = sock
+        self.packet = packet
+        self.encoder = encoder or ErlangTermEncoder()
+        self.stream = TermStreamDecoder(packet, decoder)
+        self.chunk = bytearray(chunk_size)
+        self.received = collections.deque()
+        self.outgoing = bytearray()
+
+    def send(self, obj):
+        self.send_many([obj])
+
+    def send_many(self, objs):
+        buf = self.outgoing
+        del buf[:]
+        for obj in objs:
+            encode_frame(self.encoder, obj, buf, self.packet)
+        self.socket.sendall(buf)
+        if len(buf) > 4 * len(self.chunk):
+            # Don't hold on to the memory of an exceptionally large term
+            self.outgoing = bytearray()
+
+    def send_frames(self, frames):
+        """Send terms already encoded, with their version byte"""
+        packet = self.packet
+        if not packet:
+            sendmsg_all(self.socket, frames)
+            return
+        header = _HEADERS[packet]
+        buffers = []
+        for frame in frames:
+            if len(frame) >> (8 * packet):
+                raise ValueError("Term of %d bytes too large for {packet,%d}" % (len(frame), packet))
+            buffers.append(header.pack(len(frame)))
+            buffers.append(frame)
+        sendmsg_all(self.socket, buffers)
+
+    def receive(self):
+        """Return the list of the terms received next, empty once the
+        connection is closed"""
+        if self.received:
+            terms = list(self.received)
+            self.received.clear()
+            return terms
+        return self.read(self.stream.feed)
+
+    def receive_frames(self):
+        """Return the list of the terms received next still encoded, as
+        bytes starting with the version byte, empty once the connection is
+        closed"""
+        return self.read(self.stream.feed_frames)
+
+    def read(self, feed):
+        with memoryview(self.chunk) as chunk:
+            while True:
+                size = self.socket.recv_into(chunk)
+                if not size:
+                    if len(self.stream):
+                        raise EncodingError("Connection closed in the middle of a term")
+                    return []
+                terms = feed(chunk[:size])
+                if terms:
+                    return terms
+
+    def recv(self):
+        """Return the next term received"""
+        if not self.received:
+            terms = self.receive()
+            if not terms:
+                raise ConnectionError("Connection closed")
+            self.received.extend(terms)
+        return self.received.popleft()
+
+    def __iter__(self):
+        while True:
+            terms = self.receive()
+            if not terms:
+                return
+            for term in terms:
+                yield term
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def connect(address, packet=4, timeout=None, **kwargs):
+    sock = socket.create_connection(address, timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return TermConnection(sock, packet, **kwargs)
+
+def call(address, obj, packet=4, timeout=None):
+    """Send obj over a new connection to address and return the reply"""
+    with connect(address, packet, timeout) as connection:
+        connection.send(obj)
+        return connection.recv()
+
+class TermClient(object):
+    """Send requests to a server answering each with a reply, in order, over
+    a pool of persistent connections.
+
+    call() sends a request and waits for its reply. call_many() pipelines
+    requests: they are all sent at once over a single connection before
+    their replies are read. Up to size connections are opened, as needed,
+    callers waiting for one to be free beyond that. A connection that
+    fails is closed rather than returned to the pool.
+    """
+
+    def __init__(self, address, packet=4, size=4, timeout=None, encoder=None, decoder=None):
+        self.address = address
+        self.packet = packet
+        self.timeout = timeout
+        self.encoder = encoder or ErlangTermEncoder()
+        self.decoder = decoder
+        self.slots = threading.BoundedSemaphore(size)
+        # Idle connections, the most recently used last
+        self.idle = queue.LifoQueue()
+        self.closed = False
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return connect(self.address, self.packet, self.timeout,
+                           encoder=self.encoder, decoder=self.decoder)
+        except:
+            self.slots.release()
+            raise
+
+    def release(self, connection, failed=False):
+        if failed or self.closed:
+            connection.close()
+        else:
+            self.idle.put(connection)
+        self.slots.release()
+
+    def call(self, obj):
+        return self.call_many([obj])[0]
+
+    def call_many(self, objs):
+        connection = self.acquire()
+        try:
+            connection.send_many(objs)
+            replies = [connection.recv() for obj in objs]
+        except:
+            self.release(connection, failed=True)
+            raise
+        self.release(connection)
+        return replies
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class TermServer(object):
+    """Serve requests from Erlang (or TermClient) over TCP, each connection
+    in a thread of its own.
+
+    handler is called with each request term and returns the reply term. If
+    it raises, or the request can't be decoded, the reply is {error, Repr}
+    instead. Requests pipelined by the client are handled in order and
+    their replies sent together. A connection whose framing is broken
+    (as by a frame over the decoder's max_size) is closed.
+    """
+
+    def __init__(self, handler, address=("127.0.0.1", 0), packet=4, encoder=None,
+                 decoder=None, backlog=128):
+        self.handler = handler
+        self.packet = packet
+        self.encoder = encoder or ErlangTermEncoder()
+        self.decoder = decoder
+        self.socket = socket.create_server(address, backlog=backlog)
+        self.address = self.socket.getsockname()
+        self.lock = threading.Lock()
+        self.connections = set()
+
+    def serve_forever(self):
+        """Accept connections until close() is called"""
+        while True:
+            try:
+                sock, peer = self.socket.accept()
+            except OSError:
+                # Closed
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self.serve_connection, args=(sock,), daemon=True)
+            thread.start()
+
+    def start(self):
+        """Serve in a background thread and return it"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def serve_connection(self, sock):
+        connection = TermConnection(sock, self.packet, self.encoder, self.decoder)
+        with self.lock:
+            self.connections.add(connection)
+        try:
+            decode = connection.stream.decoder.decode
+            while True:
+                frames = connection.receive_frames()
+                if not frames:
+                    return
+                connection.send_many([self.reply(decode, frame) for frame in frames])
+        except (OSError, EncodingError):
+            return
+        finally:
+            with self.lock:
+                self.connections.discard(connection)
+            connection.close()
+
+    def reply(self, decode, frame):
+        try:
+            return self.handler(decode(frame))
+        except Exception as e:
+            return (Atom("error"), repr(e))
+
+    def close(self):
+        try:
+            # Wakes up serve_forever, which close alone may not
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
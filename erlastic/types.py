@@ -1,39 +1,108 @@
 
-__all__ = ['Atom', 'Reference', 'Port', 'PID', 'Export']
+import array
+import collections.abc
+
+__all__ = ['Atom', 'Reference', 'Port', 'PID', 'Export', 'RawTerm', 'FrozenMap']
 
 class Atom(str):
     def __repr__(self):
         return "Atom(%s)" % super(Atom, self).__repr__()
 
-class Reference(object):
-    def __init__(self, node, ref_id, creation):
-        if not isinstance(ref_id, tuple):
-            ref_id = tuple(ref_id)
-        self.node = node
-        self.ref_id = ref_id
-        self.creation = creation
+# Node (and module and function) names are shared by every instance
+_nodes = {}
+
+def shared_atom(node):
+    atom = _nodes.get(node)
+    if atom is None:
+        atom = node if isinstance(node, Atom) else Atom(node)
+        if len(_nodes) < 4096:
+            _nodes[atom] = atom
+    return atom
+
+class Identifier(object):
+    """Base of the immutable Erlang identifiers.
+
+    Instances are hashable and ordered as in Erlang: references sort before
+    funs, then ports and pids. Instances of the same type are compared
+    field by field. The hash is computed the first time it is needed and
+    kept from then on.
+    """
+
+    __slots__ = ('_hash',)
+    _fields = ()
+    _order = 0
+
+    def __init__(self, *values):
+        for name, value in zip(self._fields, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+    def __delattr__(self, name):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __reduce__(self):
+        return (self.__class__, self.key())
+
+    def key(self):
+        return tuple([getattr(self, name) for name in self._fields])
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            value = hash((self.__class__.__name__,) + self.key())
+            object.__setattr__(self, '_hash', value)
+            return value
 
     def __eq__(self, other):
-        return isinstance(other, Reference) and self.node == other.node and self.ref_id == other.ref_id and self.creation == other.creation
+        return isinstance(other, self.__class__) and self.key() == other.key()
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def compare_key(self):
+        return (self._order, self.key())
+
+    def __lt__(self, other):
+        if not isinstance(other, Identifier):
+            return NotImplemented
+        return self.compare_key() < other.compare_key()
+    def __le__(self, other):
+        if not isinstance(other, Identifier):
+            return NotImplemented
+        return self.compare_key() <= other.compare_key()
+    def __gt__(self, other):
+        if not isinstance(other, Identifier):
+            return NotImplemented
+        return self.compare_key() > other.compare_key()
+    def __ge__(self, other):
+        if not isinstance(other, Identifier):
+            return NotImplemented
+        return self.compare_key() >= other.compare_key()
+
+class Reference(Identifier):
+    __slots__ = ('node', 'ref_id', 'creation')
+    _fields = __slots__
+    _order = 0
+
+    def __init__(self, node, ref_id, creation):
+        if not isinstance(ref_id, tuple):
+            ref_id = tuple(ref_id)
+        Identifier.__init__(self, shared_atom(node), ref_id, creation)
+
     def __str__(self):
         return "#Ref<%d.%s>" % (self.creation, ".".join(str(i) for i in self.ref_id))
 
     def __repr__(self):
         return "%s::%s" % (self.__str__(), self.node)
 
-class Port(object):
-    def __init__(self, node, port_id, creation):
-        self.node = node
-        self.port_id = port_id
-        self.creation = creation
+class Port(Identifier):
+    __slots__ = ('node', 'port_id', 'creation')
+    _fields = __slots__
+    _order = 2
 
-    def __eq__(self, other):
-        return isinstance(other, Port) and self.node == other.node and self.port_id == other.port_id and self.creation == other.creation
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def __init__(self, node, port_id, creation):
+        Identifier.__init__(self, shared_atom(node), port_id, creation)
 
     def __str__(self):
         return "#Port<%d.%d>" % (self.creation, self.port_id)
@@ -41,17 +110,13 @@ class Port(object):
     def __repr__(self):
         return "%s::%s" % (self.__str__(), self.node)
 
-class PID(object):
-    def __init__(self, node, pid_id, serial, creation):
-        self.node = node
-        self.pid_id = pid_id
-        self.serial = serial
-        self.creation = creation
+class PID(Identifier):
+    __slots__ = ('node', 'pid_id', 'serial', 'creation')
+    _fields = __slots__
+    _order = 3
 
-    def __eq__(self, other):
-        return isinstance(other, PID) and self.node == other.node and self.pid_id == other.pid_id and self.serial == other.serial and self.creation == other.creation
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def __init__(self, node, pid_id, serial, creation):
+        Identifier.__init__(self, shared_atom(node), pid_id, serial, creation)
 
     def __str__(self):
         return "<%d.%d.%d>" % (self.creation, self.pid_id, self.serial)
@@ -59,19 +124,154 @@ class PID(object):
     def __repr__(self):
         return "%s::%s" % (self.__str__(), self.node)
 
-class Export(object):
+class Export(Identifier):
+    __slots__ = ('module', 'function', 'arity')
+    _fields = __slots__
+    _order = 1
+
     def __init__(self, module, function, arity):
-        self.module = module
-        self.function = function
-        self.arity = arity
+        Identifier.__init__(self, shared_atom(module), shared_atom(function), arity)
+
+    def __str__(self):
+        return "#Fun<%s.%s.%d>" % (self.module, self.function, self.arity)
+
+    def __repr__(self):
+        return self.__str__()
+
+class RawTerm(object):
+    """An encoded term, spliced as is into the terms it is part of by the
+    encoder. data may start with a version byte."""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        data = bytes(data)
+        if data[:1] == b"\x83":
+            data = data[1:]
+        if data[:1] == b"P":
+            raise ValueError("Compressed terms can't be embedded in other terms")
+        self.data = data
 
     def __eq__(self, other):
-        return isinstance(other, Export) and self.module == other.module and self.function == other.function and self.arity == other.arity
+        return isinstance(other, RawTerm) and self.data == other.data
     def __ne__(self, other):
         return not self.__eq__(other)
+    def __hash__(self):
+        return hash(self.data)
 
-    def __str__(self):
-        return "#Fun<%s.%s.%d>" % (self.module, self.function, self.arity)
+    def __repr__(self):
+        return "RawTerm(%r)" % self.data
+
+class _Step(object):
+    """A step of freeze other than freezing a term"""
+    __slots__ = ('kind', 'state')
+
+    def __init__(self, kind, state):
+        self.kind = kind
+        self.state = state
+
+_START_PAIR, _END_PAIR, _END_MAP = range(3)
+
+def freeze(term):
+    """Return a hashable equivalent of a decoded term, to look up lists and
+    maps in a FrozenMap.
+
+    Terms other than tuples, lists, maps, floats and booleans are their own
+    equivalent. The others are flattened into a tuple of tokens: the type
+    of each container and its length followed by its elements, the pairs of
+    maps sorted, as well as the type of floats and booleans, as in Erlang
+    1, 1.0 and true are different keys. Type objects can't be part of a
+    decoded term, so this is unambiguous. Being flat, the result is hashed
+    and compared without recursion, whatever the depth of the term.
+    """
+    cls = term.__class__
+    if cls is not tuple and not isinstance(term, (list, array.array, dict, FrozenMap)):
+        return (cls, term) if cls is float or cls is bool else term
+    out = []
+    todo = [term]
+    while todo:
+        term = todo.pop()
+        cls = term.__class__
+        if cls is _Step:
+            kind, state = term.kind, term.state
+            if kind == _START_PAIR:
+                out = []
+            elif kind == _END_PAIR:
+                state[1].append(tuple(out))
+            else:
+                out, pairs = state
+                out += (dict, len(pairs))
+                for pair in sorted(pairs, key=repr):
+                    out += pair
+        elif cls is tuple or isinstance(term, (list, array.array)):
+            out += (tuple if cls is tuple else list, len(term))
+            todo.extend(reversed(term))
+        elif isinstance(term, (dict, FrozenMap)):
+            # The enclosing tokens and the pairs frozen so far
+            state = (out, [])
+            todo.append(_Step(_END_MAP, state))
+            for key, value in term.items():
+                todo += (_Step(_END_PAIR, state), value, key, _Step(_START_PAIR, state))
+        elif cls is float or cls is bool:
+            out += (cls, term)
+        else:
+            out.append(term)
+    return tuple(out)
+
+class FrozenMap(collections.abc.Mapping):
+    """An immutable and hashable map, whose keys can be any term.
+
+    Maps are decoded as FrozenMap instead of dict when some of their keys
+    are lists or maps (or with frozen_maps=True), which also makes them
+    usable as keys themselves. Lookups accept lists and dicts as keys.
+    """
+
+    __slots__ = ('_index', '_hash')
+
+    def __init__(self, items=()):
+        if isinstance(items, collections.abc.Mapping):
+            items = items.items()
+        # (key, value) pairs by frozen key, in insertion order
+        self._index = dict((freeze(key), (key, value)) for key, value in items)
+
+    def __getitem__(self, key):
+        try:
+            return self._index[freeze(key)][1]
+        except TypeError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key, value in self._index.values():
+            yield key
+
+    def __len__(self):
+        return len(self._index)
+
+    def items(self):
+        return self._index.values()
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenMap):
+            return freeze(self) == freeze(other)
+        if isinstance(other, collections.abc.Mapping):
+            try:
+                return freeze(self) == freeze(FrozenMap(other))
+            except TypeError:
+                return False
+        return NotImplemented
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = hash(freeze(self))
+            return self._hash
+
+    def __reduce__(self):
+        return (self.__class__, (list(self.items()),))
 
     def __repr__(self):
-        return self.__str__()
+        return "FrozenMap({%s})" % ", ".join("%r: %r" % item for item in self.items())
@@ -1,8 +1,30 @@
 #!/usr/bin/env python
 
+import array
+import asyncio
+import dataclasses
+import mmap
+import operator
+import os
+import pickle
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import socket
 import unittest
+import zlib
 
-from erlastic import decode, encode
+from erlastic import ErlangTermDecoder, ErlangTermEncoder, LazyTerm, TermStreamDecoder, decode, encode
+from erlastic.aio import AsyncPortConnection
+from erlastic.cache import LRUCache
+from erlastic.compression import CompressionPolicy
+from erlastic.files import TermFileReader, TermFileWriter
+from erlastic.instrument import instrument, uninstrument
+from erlastic.server import PortServer
+from erlastic.tcp import TermClient, TermServer, call, connect, sendmsg_all
+from erlastic.codec import DecodeLimits, DecodeLimitError, EncodingError, numpy
 from erlastic.types import *
 
 erlang_term_binaries = [
@@ -62,10 +84,906 @@ class ErlangTestCase(unittest.TestCase):
             self.assertEqual(python, decoded)
             self.assertTrue(isinstance(decoded, expected_type))
 
+    def testDecodeBuffers(self):
+        for python, expected_type, erlang in erlang_term_binaries + erlang_term_decode:
+            for buf in (bytearray(erlang), memoryview(erlang)):
+                decoded = decode(buf)
+                self.assertEqual(python, decoded)
+                self.assertTrue(isinstance(decoded, expected_type))
+
+    def testDecodeMmap(self):
+        term = (Atom("foo"), [b"x" * 1000, 1.5])
+        with tempfile.TemporaryFile() as f:
+            f.write(encode(term))
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                decoded = decode(buf)
+        self.assertEqual(decoded, term)
+        self.assertTrue(isinstance(decoded[1][0], bytes))
+
+    def testDecodeBorrowed(self):
+        buf = bytearray(encode((b"foo", [102, 111, 111])))
+        decoded = ErlangTermDecoder(borrow_binaries=True).decode(buf)
+        self.assertTrue(isinstance(decoded[0], memoryview))
+        self.assertEqual(decoded[0], b"foo")
+        buf[8:11] = b"bar"
+        self.assertEqual(decoded[0], b"bar")
+        del decoded
+        buf.clear()
+
+    def testDecodeDeep(self):
+        depth = 100000
+        decoded = decode(b"\x83" + b"l\x00\x00\x00\x01" * depth + b"j" * (depth + 1))
+        for i in range(depth):
+            self.assertEqual(len(decoded), 1)
+            decoded = decoded[0]
+        self.assertEqual(decoded, [])
+        decoded = decode(b"\x83" + b"h\x02a\x07" * depth + b"h\x00")
+        for i in range(depth):
+            self.assertEqual(decoded[0], 7)
+            decoded = decoded[1]
+        self.assertEqual(decoded, ())
+
+    def testDecodeImproperList(self):
+        self.assertRaises(NotImplementedError, decode, b"\x83l\x00\x00\x00\x01a\x01a\x02")
+
     def testEncode(self):
         for python, expected_type, erlang  in erlang_term_binaries + erlang_term_encode:
             encoded = encode(python)
             self.assertEqual(erlang, encoded)
 
+    def testEncodeInto(self):
+        encoder = ErlangTermEncoder()
+        buf = bytearray(b"\x00\x00\x00\x00garbage")
+        end = encoder.encode_into((Atom("foo"), b"test", 123), buf, 4)
+        self.assertEqual(end, len(buf))
+        self.assertEqual(bytes(buf[4:]), b'\x83h\x03d\x00\x03foom\x00\x00\x00\x04testa{')
+        view = memoryview(bytearray(8))
+        self.assertEqual(encoder.encode_into(123, view, 2), 5)
+        self.assertEqual(view.tobytes(), b'\x00\x00\x83a{\x00\x00\x00')
+        self.assertRaises(ValueError, encoder.encode_into, b"foo", view, 4)
+        # Padded up to an offset past the end
+        buf = bytearray(b"ab")
+        self.assertEqual(encoder.encode_into(1, buf, 4), 7)
+        self.assertEqual(bytes(buf), b"ab\x00\x00\x83a\x01")
+        self.assertRaises(ValueError, encoder.encode_into, 1, bytearray(), -1)
+
+    def testEncodeSubclass(self):
+        class Tag(Atom):
+            pass
+        class Seq(list):
+            pass
+        self.assertEqual(encode(Seq([Tag("foo")])), b'\x83l\x00\x00\x00\x01d\x00\x03fooj')
+        self.assertRaises(NotImplementedError, encode, object())
+
+    def testEncodeCompressed(self):
+        term = [b"x" * 100] * 10
+        compressed = encode(term, compressed=True)
+        self.assertEqual(compressed[1], 80)
+        self.assertTrue(len(compressed) < len(encode(term)))
+        self.assertEqual(encode(1, compressed=9), encode(1))
+        # True stands for level 6
+        text = b" ".join(b"word%d" % (i % 500) for i in range(5000))
+        self.assertEqual(encode(text, compressed=True),
+                         b"\x83P" + struct.pack(">L", len(encode(text)) - 1) + zlib.compress(encode(text)[1:], 6))
+        for compressed in ("yes", 10, -1, 1.5):
+            self.assertRaises(TypeError, encode, text, compressed=compressed)
+
+class ProfileTestCase(unittest.TestCase):
+    term = [1.5, -0.1, Atom("ok"), Atom("\u00e9t\u00e9"), Atom("x" * 300), True, None, 2**64, -2**2100,
+            PID('nonode@nohost', 31, 0, 70000), Port('nonode@nohost', 2**40, 3),
+            Port('nonode@nohost', 7, 3), Reference('nonode@nohost', [1, 2, 3], 70000),
+            (Export('lists', 'map', 2), b"after")]
+
+    def testModern(self):
+        encoder = ErlangTermEncoder(profile="modern")
+        self.assertEqual(encoder.encode(1.5), b'\x83F?\xf8\x00\x00\x00\x00\x00\x00')
+        self.assertEqual(encoder.encode(Atom("ok")), b'\x83w\x02ok')
+        self.assertEqual(encoder.encode(True), b'\x83w\x04true')
+        encoded = encoder.encode(self.term)
+        self.assertEqual(decode(encoded), self.term)
+        self.assertTrue(len(encoder.encode(self.term[:5])) < len(encode(self.term[:5])))
+        self.assertEqual(ErlangTermDecoder().skip(encoded, 1), len(encoded))
+        self.assertRaises(ValueError, ErlangTermEncoder, profile="future")
+
+    def testModernTags(self):
+        node = b'w\x0dnonode@nohost'
+        self.assertEqual(decode(b'\x83X' + node + struct.pack(">LLL", 31, 0, 70000)),
+                         PID('nonode@nohost', 31, 0, 70000))
+        self.assertEqual(decode(b'\x83Y' + node + struct.pack(">LL", 7, 3)), Port('nonode@nohost', 7, 3))
+        self.assertEqual(decode(b'\x83x' + node + struct.pack(">QL", 2**40, 3)), Port('nonode@nohost', 2**40, 3))
+        self.assertEqual(decode(b'\x83Z\x00\x02' + node + struct.pack(">LLL", 5, 1, 2)),
+                         Reference('nonode@nohost', [1, 2], 5))
+        self.assertEqual(decode(b'\x83v\x00\x06\xc3\xa9t\xc3\xa9'), Atom("\u00e9t\u00e9"))
+        self.assertEqual(decode(b'\x83l\x00\x00\x00\x02w\x02\xc3\xa9d\x00\x02\xc3\xa9j'),
+                         [Atom("\u00e9"), Atom("\u00c3\u00a9")])
+
+    def testLegacy(self):
+        self.assertEqual(decode(encode(self.term[:9])), self.term[:9])
+        self.assertEqual(decode(encode((Export('lists', 'map', 2), b"after"))), (Export('lists', 'map', 2), b"after"))
+        self.assertEqual(encode(2**64), b'\x83n\x09\x00' + b'\x00' * 8 + b'\x01')
+
+class MapTestCase(unittest.TestCase):
+    def testEncode(self):
+        self.assertEqual(encode({}), b'\x83t\x00\x00\x00\x00')
+        self.assertEqual(encode({Atom("a"): 1}), b'\x83t\x00\x00\x00\x01d\x00\x01aa\x01')
+        for term in ({Atom("a"): 1, b"b": [1, {2: 3.5}], (1, 2): None}, [{}], {1: {2: {3: [4]}}}):
+            self.assertEqual(decode(encode(term)), term)
+
+    def testSortedKeys(self):
+        encoder = ErlangTermEncoder(sort_map_keys=True)
+        first = {Atom("b"): 1, Atom("a"): 2, b"zz": 3, b"y": 4, 5: 5, "a": 6}
+        second = dict(reversed(list(first.items())))
+        self.assertNotEqual(encode(first), encode(second))
+        self.assertEqual(encoder.encode(first), encoder.encode(second))
+        self.assertEqual(decode(encoder.encode(first)), first)
+        self.assertEqual(b"".join(encoder.iterencode([first, second], chunk_size=1)), encoder.encode([first, second]))
+
+    def testFrozenMap(self):
+        term = decode(b'\x83t\x00\x00\x00\x02d\x00\x01am\x00\x00\x00\x01bl\x00\x00\x00\x01a\x01ja\x02')
+        self.assertTrue(isinstance(term, FrozenMap))
+        self.assertEqual(term[[1]], 2)
+        self.assertEqual(term[Atom("a")], b"b")
+        self.assertRaises(KeyError, lambda: term[[2]])
+        self.assertEqual(decode(encode(term)), term)
+        self.assertEqual(pickle.loads(pickle.dumps(term)), term)
+        frozen = ErlangTermDecoder(frozen_maps=True).decode(encode({Atom("a"): [1]}))
+        self.assertEqual(frozen, FrozenMap({Atom("a"): [1]}))
+        self.assertEqual(frozen, {Atom("a"): [1]})
+        self.assertEqual({frozen: 1}[FrozenMap([(Atom("a"), [1])])], 1)
+        self.assertEqual(decode(encode({frozen: 1})), FrozenMap([(frozen, 1)]))
+
+    def testEqualKeys(self):
+        # #{1 => a, 1.0 => b, true => c}
+        term = decode(b'\x83t\x00\x00\x00\x03a\x01s\x01aF?\xf0\x00\x00\x00\x00\x00\x00s\x01bs\x04trues\x01c')
+        self.assertTrue(isinstance(term, FrozenMap))
+        self.assertEqual((len(term), term[1], term[1.0], term[True]), (3, Atom("a"), Atom("b"), Atom("c")))
+        self.assertNotEqual(FrozenMap({1: 2}), {1.0: 2})
+        self.assertEqual(decode(ErlangTermEncoder(profile="modern").encode(term)), term)
+        # A string and a binary, both decoded as bytes
+        self.assertRaises(EncodingError, decode, b'\x83t\x00\x00\x00\x02k\x00\x01aa\x01m\x00\x00\x00\x01aa\x02')
+
+    def testDeepKeys(self):
+        key = []
+        for i in range(5000):
+            key = [(key,)]
+        buf = b'\x83t\x00\x00\x00\x01' + b'l\x00\x00\x00\x01h\x01' * 5000 + b'j' * 5001 + b'a\x01'
+        term = ErlangTermDecoder().decode(buf)
+        self.assertEqual(term[key], 1)
+        self.assertEqual(hash(term), hash(FrozenMap(term)))
+        self.assertEqual({Atom("a"): {1: [{2.5: b"x"}]}}, FrozenMap({Atom("a"): FrozenMap({1: [{2.5: b"x"}]})}))
+
+    def testScan(self):
+        buf = encode([{Atom("a"): [1, 2]}, 3])
+        self.assertEqual(ErlangTermDecoder().skip(buf, 1), len(buf))
+        self.assertEqual(ErlangTermDecoder().extract(buf, (1,)), 3)
+
+@dataclasses.dataclass
+class User(object):
+    id: int
+    name: str
+    role: Atom
+    groups: list
+
+class Point(object):
+    __slots__ = ('x', 'y')
+
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+    def __eq__(self, other):
+        return (self.x, self.y) == (other.x, other.y)
+
+class Node(object):
+    __slots__ = ('name', 'child')
+    __annotations__ = {'name': Atom}
+
+class RecordTestCase(unittest.TestCase):
+    def testDecode(self):
+        decoder = ErlangTermDecoder()
+        decoder.register_record("user", User)
+        decoder.register_record("point", Point)
+        term = (Atom("user"), 1, b"jo", Atom("admin"), [(Atom("point"), 1.5, 2**40)])
+        self.assertEqual(decoder.decode(encode(term)), User(1, "jo", Atom("admin"), [Point(1.5, 2**40)]))
+        self.assertEqual(decoder.decode(ErlangTermEncoder(profile="modern").encode(term)),
+                         User(1, "jo", Atom("admin"), [Point(1.5, 2**40)]))
+        # Other tags or arities
+        for other in ((Atom("user"), 1), (Atom("admin"), 1, b"jo", Atom("admin"), []), (), (1, 2)):
+            self.assertEqual(decoder.decode(encode(other)), other)
+        self.assertEqual(decoder.decode(encode(term), raw=[(4,)])[4], RawTerm(encode(term[4])))
+
+    def testEncode(self):
+        encoder = ErlangTermEncoder()
+        encoder.register_record("user", User)
+        encoder.register_record(Atom("point"), Point, fields=("y", "x"), types=(float, float))
+        self.assertEqual(encoder.encode(User(1, "jo", Atom("admin"), [Point(1.5, 2)])),
+                         encode((Atom("user"), 1, "jo", Atom("admin"), [(Atom("point"), 2, 1.5)])))
+        decoder = ErlangTermDecoder()
+        decoder.register_record("user", User)
+        self.assertEqual(decoder.decode(encoder.encode(User(2**70, "\u00e9", Atom("x"), None))),
+                         User(2**70, "\u00e9", Atom("x"), None))
+        self.assertRaises(ValueError, encoder.register_record, "thing", object)
+
+    def testNesting(self):
+        def chain(depth):
+            return b"\x83" + b"h\x03s\x04nodes\x01nl\x00\x00\x00\x01" * depth + b"j" * (depth + 1)
+        decoder = ErlangTermDecoder()
+        decoder.register_record("node", Node)
+        node, depth = decoder.decode(chain(5000)), 0
+        while node != []:
+            self.assertEqual(node.name, Atom("n"))
+            node, depth = node.child[0], depth + 1
+        self.assertEqual(depth, 5000)
+        # Records count towards the depth and atoms of the whole term
+        for limits in (DecodeLimits(max_depth=50), DecodeLimits(max_atoms=100)):
+            decoder = ErlangTermDecoder(limits=limits)
+            decoder.register_record("node", Node)
+            self.assertEqual(decoder.decode(chain(20)).child[0].child[0].name, Atom("n"))
+            self.assertRaises(DecodeLimitError, decoder.decode, chain(200))
+
+class LimitsTestCase(unittest.TestCase):
+    def testLengths(self):
+        decoder = ErlangTermDecoder()
+        for buf in (b'\x83l\xff\xff\xff\xffj', b'\x83i\xff\xff\xff\xffa\x01', b'\x83t\x80\x00\x00\x00a\x01a\x01',
+                    b'\x83h\x03a\x01'):
+            self.assertRaises(EncodingError, decoder.decode, buf)
+        limited = ErlangTermDecoder(limits=DecodeLimits(max_length=50))
+        self.assertEqual(limited.decode(encode([(1,)] * 50)), [(1,)] * 50)
+        for term in ([(1,)] * 51, (1,) * 51, dict.fromkeys(range(51)), list(range(51))):
+            self.assertRaises(DecodeLimitError, limited.decode, encode(term))
+
+    def testDepth(self):
+        term = []
+        for i in range(10):
+            term = [(term,)]
+        decoder = ErlangTermDecoder(limits=DecodeLimits(max_depth=20))
+        self.assertEqual(decoder.decode(encode(term)), term)
+        self.assertRaises(DecodeLimitError, decoder.decode, encode([term]))
+
+    def testAtoms(self):
+        decoder = ErlangTermDecoder(limits=DecodeLimits(max_atoms=5))
+        self.assertEqual(decoder.decode(encode([Atom("a")] * 5)), [Atom("a")] * 5)
+        self.assertRaises(DecodeLimitError, decoder.decode, encode([Atom("a")] * 6))
+
+    def testSize(self):
+        decoder = ErlangTermDecoder(limits=DecodeLimits(max_size=100))
+        self.assertEqual(decoder.decode(encode(b"x" * 90)), b"x" * 90)
+        self.assertRaises(DecodeLimitError, decoder.decode, encode(b"x" * 100))
+        stream = TermStreamDecoder(packet=4, decoder=decoder)
+        self.assertRaises(DecodeLimitError, stream.feed, struct.pack(">L", 1 << 30))
+        stream = TermStreamDecoder(packet=0, decoder=decoder)
+        self.assertRaises(DecodeLimitError, stream.feed, encode(b"x" * 200)[:150])
+
+    def testDecompressed(self):
+        bomb = encode([b"\x00" * (1 << 20)] * 4, compressed=9)
+        self.assertEqual(len(decode(bomb)), 4)
+        decoder = ErlangTermDecoder(limits=DecodeLimits(max_decompressed=1 << 20))
+        self.assertRaises(DecodeLimitError, decoder.decode, bomb)
+        self.assertRaises(DecodeLimitError, decoder.skip, bomb, 1, True)
+        # Declaring less than the actual size
+        lying = bomb[:2] + struct.pack(">L", 1000) + bomb[6:]
+        self.assertRaises(EncodingError, decode, lying)
+        self.assertRaises(EncodingError, ErlangTermDecoder().skip, lying, 1, True)
+        self.assertRaises(EncodingError, decode, bomb[:-10])
+        stream = TermStreamDecoder(packet=0, decoder=decoder)
+        self.assertRaises(DecodeLimitError, stream.feed, bomb)
+        # Declaring a size of 0, which zlib would take as no limit
+        empty = bomb[:2] + struct.pack(">L", 0) + bomb[6:]
+        self.assertRaises(EncodingError, decoder.decode, empty)
+        self.assertRaises(EncodingError, decoder.skip, empty, 1, True)
+        self.assertRaises(EncodingError, TermStreamDecoder(packet=0, decoder=decoder).feed, empty)
+
+    def testNestedCompressed(self):
+        # Only allowed right after the version byte, where a term is
+        # inflated once, rather than each element against the limit
+        part = encode(b"\x00" * (1 << 20), compressed=9)[1:]
+        repeated = b"\x83l" + struct.pack(">L", 50) + part * 50 + b"j"
+        decoder = ErlangTermDecoder(limits=DecodeLimits(max_decompressed=1 << 20, max_size=1 << 20))
+        twice = b"\x83P" + struct.pack(">L", len(part)) + zlib.compress(part)
+        for buf in (repeated, b"\x83h\x01" + part, twice):
+            self.assertRaises(EncodingError, decoder.decode, buf)
+            self.assertRaises(EncodingError, decode, buf)
+            self.assertRaises(EncodingError, TermStreamDecoder(packet=0, decoder=decoder).feed, buf)
+            if buf is not twice:
+                # Skipping a compressed term doesn't look into its contents
+                self.assertRaises(EncodingError, decoder.skip, buf, 1, True)
+        self.assertRaises(EncodingError, decoder.skip, encode(b"x" * 1000, compressed=True), 1)
+        # Nested deep
+        nested = b"\x01"
+        for i in range(3000):
+            nested = b"h\x01P" + struct.pack(">L", len(nested)) + zlib.compress(nested, 0)
+        decoder = ErlangTermDecoder(limits=DecodeLimits(max_depth=10))
+        self.assertRaises(EncodingError, decoder.decode, b"\x83" + nested)
+
+class CompressionPolicyTestCase(unittest.TestCase):
+    def testPolicy(self):
+        policy = CompressionPolicy(threshold=100, sample_size=1000)
+        encoder = ErlangTermEncoder(compression=policy)
+        terms = [b"x" * 50, b"x" * 5000, os.urandom(5000), [os.urandom(100) for i in range(50)]]
+        for term in terms:
+            encoded = encoder.encode(term)
+            self.assertEqual(decode(encoded), term)
+            self.assertEqual(encoded[1] == 80, term == b"x" * 5000)
+        stats = policy.stats
+        self.assertEqual((stats.terms, stats.compressed, stats.too_small, stats.incompressible), (4, 1, 1, 2))
+        self.assertEqual(stats.bytes_in, sum(len(encode(term)) - 1 for term in terms))
+        self.assertTrue(stats.bytes_out < stats.bytes_in and stats.ratio < 1)
+        self.assertEqual(encoder.encode(b"x" * 5000, compressed=False), encode(b"x" * 5000))
+        self.assertEqual(encode(b"x" * 5000, compressed=policy), encoder.encode(b"x" * 5000))
+
+    def testLevels(self):
+        policy = CompressionPolicy(levels=[(0, 9), (100, 5), (1000, 1)])
+        self.assertEqual([policy.level(size) for size in (0, 99, 100, 999, 5000)], [9, 9, 5, 5, 1])
+
+class InstrumentTestCase(unittest.TestCase):
+    term = (Atom("ok"), [1.5, 2**70, 300], b"data")
+
+    def testDecoder(self):
+        decoder = ErlangTermDecoder()
+        buf = encode(self.term)
+        stats = instrument(decoder)
+        self.assertRaises(ValueError, instrument, decoder)
+        self.assertEqual(decoder.decode(buf), self.term)
+        self.assertEqual(decoder.decode(b"\x00" + buf, 1), self.term)
+        self.assertEqual((stats.terms, stats.bytes), (2, 2 * len(buf)))
+        self.assertEqual(stats.tags, {"SMALL_TUPLE_EXT": [2, 4], "ATOM_EXT": [2, 10], "LIST_EXT": [2, 10],
+                                      "FLOAT_EXT": [2, 64], "SMALL_BIG_EXT": [2, 24], "INTEGER_EXT": [2, 10],
+                                      "NIL_EXT": [2, 2], "BINARY_EXT": [2, 18]})
+        self.assertEqual(stats.handlers["FLOAT_EXT"][0], 2)
+        self.assertEqual(stats.handlers["STRING_EXT"][0], 0)
+        self.assertTrue("FLOAT_EXT" in stats.report())
+        self.assertTrue(uninstrument(decoder) is stats)
+        decoder.decode(buf)
+        self.assertEqual(stats.terms, 2)
+        self.assertEqual(stats.handlers["FLOAT_EXT"][0], 2)
+
+    def testEncoder(self):
+        encoder = ErlangTermEncoder()
+        stats = instrument(encoder)
+        buf = bytearray(b"xx")
+        encoder.encode_into(self.term, buf, 2)
+        self.assertEqual(encoder.encode(self.term), bytes(buf[2:]))
+        self.assertEqual((stats.terms, stats.bytes), (2, 2 * len(buf[2:])))
+        self.assertEqual(stats.tags["ATOM_EXT"], [2, 10])
+        self.assertEqual(stats.handlers["encode_tuple"][0], 2)
+        self.assertEqual(stats.handlers["encode_int"][0], 4)
+        # Compressed terms are counted as a whole
+        encoder.encode([b"x" * 1000], compressed=True)
+        self.assertEqual(stats.tags["COMPRESSED"][0], 1)
+        uninstrument(encoder)
+        self.assertEqual(encoder.encode(self.term), bytes(buf[2:]))
+        self.assertEqual(stats.terms, 3)
+        self.assertFalse(hasattr(encoder.encoders[tuple], "__wrapped__"))
+
+class IterencodeTestCase(unittest.TestCase):
+    term = [(Atom("row"), i, [b"x" * i, "y" * i], ()) for i in range(200)] + [b"z" * 5000, [], (1, [[2]])]
+
+    def testChunks(self):
+        for term in (self.term, 1, [], (Atom("a"),) * 300, [python for python, _, _ in erlang_term_binaries]):
+            chunks = list(ErlangTermEncoder().iterencode(term, chunk_size=100))
+            self.assertEqual(b"".join(chunks), encode(term))
+        chunks = list(ErlangTermEncoder().iterencode(self.term, chunk_size=1000))
+        chunks.remove(b"z" * 5000)
+        self.assertTrue(max(len(chunk) for chunk in chunks) < 2000)
+
+    def testMaps(self):
+        for cls in (dict, FrozenMap):
+            term = cls((i, b"x" * 100) for i in range(100))
+            encoder = ErlangTermEncoder()
+            for instrumented in (False, True):
+                if instrumented:
+                    instrument(encoder)
+                chunks = list(encoder.iterencode(term, chunk_size=1000))
+                self.assertEqual(b"".join(chunks), encode(term))
+                # The map is chunked rather than encoded in one go
+                self.assertTrue(max(len(chunk) for chunk in chunks) < 2000)
+
+    def testCompressed(self):
+        chunks = list(ErlangTermEncoder().iterencode(self.term, chunk_size=100, compressed=True))
+        self.assertEqual(chunks[0][:2], b"\x83P")
+        self.assertEqual(decode(b"".join(chunks)), decode(encode(self.term)))
+
+    def testDump(self):
+        encoder = ErlangTermEncoder(cache=True)
+        with tempfile.TemporaryFile() as f:
+            written = encoder.dump(self.term, f, chunk_size=100)
+            encoder.dump(self.term, f, compressed=9)
+            f.seek(0)
+            data = f.read()
+        self.assertEqual(data[:written], encode(self.term))
+        self.assertEqual(decode(data[written:]), decode(encode(self.term)))
+
+class IdentifierTestCase(unittest.TestCase):
+    def testHashable(self):
+        pid = PID('nonode@nohost', 31, 0, 0)
+        table = {pid: 1, Reference('nonode@nohost', [33, 0, 0], 0): 2, Port('nonode@nohost', 455, 0): 3,
+                 Export('jobqueue', 'stats', 0): 4}
+        self.assertEqual(table[decode(encode(pid))], 1)
+        self.assertEqual(table[Reference('nonode@nohost', (33, 0, 0), 0)], 2)
+        self.assertNotEqual(pid, PID('nonode@nohost', 31, 0, 1))
+        self.assertNotEqual(Port('nonode@nohost', 31, 0), PID('nonode@nohost', 31, 0, 0))
+
+    def testImmutable(self):
+        pid = PID('nonode@nohost', 31, 0, 0)
+        self.assertRaises(AttributeError, setattr, pid, "pid_id", 32)
+        self.assertRaises(AttributeError, setattr, pid, "extra", 1)
+        self.assertFalse(hasattr(pid, "__dict__"))
+        self.assertEqual(pickle.loads(pickle.dumps(pid)), pid)
+
+    def testOrdering(self):
+        ids = [PID('b@host', 1, 0, 0), PID('a@host', 2, 0, 0), Port('a@host', 1, 0),
+               Export('m', 'f', 1), Reference('a@host', [1], 0)]
+        self.assertEqual(sorted(ids), [ids[4], ids[3], ids[2], ids[1], ids[0]])
+
+    def testSharedNodes(self):
+        pids = decode(encode([PID('nonode@nohost', i, 0, 0) for i in range(3)]))
+        self.assertTrue(pids[0].node is pids[2].node is PID('nonode@nohost', 4, 0, 0).node)
+        self.assertTrue(isinstance(pids[0].node, Atom))
+
+class NumericListTestCase(unittest.TestCase):
+    def pack(self, items):
+        # Lists of NEW_FLOAT_EXT floats, as encode uses FLOAT_EXT
+        data = b"".join(b"F" + struct.pack(">d", item) if isinstance(item, float) else encode(item)[1:] for item in items)
+        return b"\x83l" + struct.pack(">L", len(items)) + data + b"j"
+
+    def testDecode(self):
+        lists = [[1, 2, 3], list(range(1000)), [-1, 2**31 - 1, -2**31, 5], [1.5, -2.5, 1e300],
+                 [1, 2.5, 300, 4.0, 7], [1, 2, Atom("x"), 3, 4], [1, 2**40, 3], [Atom("a"), 1, 2]]
+        for decoder in (ErlangTermDecoder(), ErlangTermDecoder(borrow_binaries=True)):
+            for items in lists:
+                decoded = decoder.decode(self.pack(items))
+                self.assertEqual(decoded, items)
+                self.assertEqual([type(item) for item in decoded], [type(item) for item in items])
+        self.assertRaises(NotImplementedError, decode, b"\x83l\x00\x00\x00\x02a\x01a\x02a\x03")
+
+    def testDecodeArrays(self):
+        decoder = ErlangTermDecoder(numeric_lists="array")
+        self.assertEqual(decoder.decode(self.pack([1, 300, -5])), array.array('i', [1, 300, -5]))
+        self.assertEqual(decoder.decode(self.pack([1.5, 3.0])), array.array('d', [1.5, 3.0]))
+        self.assertEqual(decoder.decode(self.pack([1, 3.0])), [1, 3.0])
+        self.assertEqual(decoder.decode(b'\x83k\x00\x03foo'), array.array('B', b"foo"))
+        self.assertEqual(decoder.decode(encode([(1, 2)])), [(1, 2)])
+        mixed = [1, 300] * 20
+        self.assertEqual(decoder.decode(self.pack(mixed)), array.array('i', mixed))
+        self.assertEqual(decoder.decode(self.pack(mixed + [2**40])), mixed + [2**40])
+        self.assertEqual(decode(self.pack([5] * 20 + mixed)), [5] * 20 + mixed)
+
+    def testEncodeArrays(self):
+        self.assertEqual(encode(array.array('q', [1, 2, 255])), b'\x83k\x00\x03\x01\x02\xff')
+        self.assertEqual(encode(array.array('B')), encode([]))
+        for values in ([1, -2, 300], [1, 2**40, -5], [1.5, -2.0, 0.1]):
+            typecode = 'd' if isinstance(values[0], float) else 'q'
+            self.assertEqual(decode(encode(array.array(typecode, values))), values)
+            self.assertEqual(decode(encode(memoryview(array.array(typecode, values)))), values)
+        self.assertEqual(encode(array.array('i', [1, -2, 300])), self.pack([1, -2, 300]).replace(b"a\x01", b"b\x00\x00\x00\x01"))
+        self.assertEqual(encode(memoryview(b"foo")), encode(b"foo"))
+        self.assertEqual(encode(memoryview(b"xfoox")[1:4]), encode(b"foo"))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def testNumpy(self):
+        decoder = ErlangTermDecoder(numeric_lists="numpy")
+        self.assertEqual(decoder.decode(self.pack([1, 300, -5])).tolist(), [1, 300, -5])
+        for values in ([1, 2, 3], [1, -2, 300], [1.5, 2.5]):
+            self.assertEqual(decode(encode(numpy.array(values))), values)
+
+class LazyTermTestCase(unittest.TestCase):
+    term = (Atom("call"), [1, (b"meta", 2.5), []], [b"x" * 100] * 20, PID('nonode@nohost', 31, 0, 0))
+
+    def testExtract(self):
+        decoder = ErlangTermDecoder()
+        for buf in (encode(self.term), encode(self.term, compressed=True), memoryview(encode(self.term))):
+            self.assertEqual(decoder.extract(buf), self.term)
+            self.assertEqual(decoder.extract(buf, (0,)), Atom("call"))
+            self.assertEqual(decoder.extract(buf, (1, 1, 0)), b"meta")
+            self.assertEqual(decoder.extract(buf, (-1,)), self.term[-1])
+            self.assertEqual(decoder.extract(buf, (1,), raw=True), encode(self.term[1]))
+            self.assertRaises(IndexError, decoder.extract, buf, (1, 3))
+            self.assertRaises(TypeError, decoder.extract, buf, (0, 0))
+
+    def testLazyTerm(self):
+        lazy = LazyTerm(encode(self.term))
+        self.assertEqual(len(lazy), 4)
+        self.assertEqual(lazy[0], Atom("call"))
+        self.assertTrue(isinstance(lazy[1], LazyTerm))
+        self.assertEqual(lazy[1][1][1], 2.5)
+        self.assertEqual(len(lazy[1][2]), 0)
+        self.assertEqual([item for item in lazy[2]], self.term[2])
+        self.assertEqual(lazy[1].decode(), self.term[1])
+        self.assertEqual(lazy[2].raw, encode(self.term[2]))
+        self.assertEqual(lazy.extract((3,), raw=True), encode(self.term[3]))
+        self.assertRaises(TypeError, LazyTerm, encode(1))
+
+    def testTruncated(self):
+        buf = encode(self.term)[:-60]
+        self.assertEqual(ErlangTermDecoder().extract(buf, (1, 1)), (b"meta", 2.5))
+        self.assertRaises(EncodingError, ErlangTermDecoder().extract, buf, (3,))
+
+class RawTermTestCase(unittest.TestCase):
+    def testEncode(self):
+        payload = encode([b"x", 1.5])
+        self.assertEqual(encode((Atom("ok"), RawTerm(payload))), encode((Atom("ok"), [b"x", 1.5])))
+        self.assertEqual(RawTerm(payload), RawTerm(payload[1:]))
+        self.assertRaises(ValueError, RawTerm, encode([b"x" * 100] * 10, compressed=True))
+
+    def testDecode(self):
+        term = (Atom("call"), [1, (b"meta", 2.5)], [b"x" * 100] * 20)
+        for buf in (encode(term), encode(term, compressed=True)):
+            decoded = ErlangTermDecoder().decode(buf, raw=[(2,), (1, 1)])
+            self.assertEqual(decoded, (Atom("call"), [1, RawTerm(encode(term[1][1]))], RawTerm(encode(term[2]))))
+            self.assertEqual(encode(decoded), encode(term))
+
+class EncoderCacheTestCase(unittest.TestCase):
+    def testCache(self):
+        encoder = ErlangTermEncoder(cache=LRUCache(3))
+        terms = [(Atom("ok"), 1), (Atom("ok"), True), PID('nonode@nohost', 31, 0, 0),
+                 [(Atom("ok"), 1.5)] * 2, (Atom("ok"), (1, 2))]
+        for i in range(3):
+            self.assertEqual([encoder.encode(term) for term in terms], [encode(term) for term in terms])
+        self.assertEqual(len(encoder.cache), 3)
+        self.assertTrue(0 < encoder.cache.hit_rate < 1)
+
+    def testLRUCache(self):
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        self.assertEqual(cache.get("a"), 1)
+        cache["c"] = 3
+        self.assertEqual((cache.get("b"), cache.get("a"), cache.get("c")), (None, 1, 3))
+        self.assertEqual(cache.stats(), {"hits": 3, "misses": 1, "hit_rate": 0.75, "size": 2, "maxsize": 2})
+
+class AtomCacheTestCase(unittest.TestCase):
+    def testDecode(self):
+        decoder = ErlangTermDecoder(atom_cache=LRUCache(2))
+        decoded = decoder.decode(encode([Atom("foo"), Atom("foo"), True, Atom("bar"), None, Atom("foo")]))
+        self.assertEqual(decoded, [Atom("foo"), Atom("foo"), True, Atom("bar"), None, Atom("foo")])
+        self.assertTrue(decoded[0] is decoded[1])
+        self.assertFalse(decoded[0] is decoded[5])
+        self.assertEqual(len(decoder.atom_cache), 2)
+        self.assertEqual((decoder.atom_cache.hits, decoder.atom_cache.misses), (1, 5))
+        decoded = ErlangTermDecoder(atom_cache=None).decode(encode([Atom("foo"), Atom("foo")]))
+        self.assertFalse(decoded[0] is decoded[1])
+
+    def testEncode(self):
+        encoder = ErlangTermEncoder()
+        for i in range(2):
+            self.assertEqual(encoder.encode((Atom("foo"), PID('nonode@nohost', 31, 0, 0))),
+                             encode((Atom("foo"), PID('nonode@nohost', 31, 0, 0))))
+        self.assertEqual((encoder.atom_cache.hits, encoder.atom_cache.misses), (2, 2))
+        self.assertEqual(ErlangTermEncoder(atom_cache=None).encode(Atom("foo")), encode(Atom("foo")))
+
+class StreamTestCase(unittest.TestCase):
+    terms = [python for python, expected_type, erlang in erlang_term_binaries] + [
+        (Atom("ok"), [b"x" * 300, (1, 2.5)] * 100),
+    ]
+
+    def frame(self, term, packet):
+        data = encode(term, compressed=isinstance(term, tuple))
+        if packet:
+            data = struct.pack(">" + " BH L"[packet], len(data)) + data
+        return data
+
+    def testFeed(self):
+        for packet in (0, 1, 2, 4):
+            data = b"".join(self.frame(term, packet) for term in self.terms if packet != 1 or len(encode(term)) < 256)
+            for chunk_size in (1, 7, len(data)):
+                stream = TermStreamDecoder(packet=packet)
+                decoded = []
+                for i in range(0, len(data), chunk_size):
+                    decoded += stream.feed(data[i:i+chunk_size])
+                self.assertEqual(decoded, [term for term in self.terms if packet != 1 or len(encode(term)) < 256])
+                self.assertEqual(len(stream), 0)
+
+    def testFeedFrames(self):
+        stream = TermStreamDecoder(packet=0)
+        data = encode(Atom("foo")) + encode([1, 2])
+        self.assertEqual(stream.feed_frames(data[:-1]), [encode(Atom("foo"))])
+        self.assertEqual(len(stream), len(encode([1, 2])) - 1)
+        self.assertEqual(stream.feed_frames(data[-1:]), [encode([1, 2])])
+
+    def testBadVersion(self):
+        self.assertRaises(EncodingError, TermStreamDecoder(packet=0).feed, b"\x84j")
+
+    def testShortFrame(self):
+        for packet in (1, 2, 4):
+            for frame in (b"", b"\x83"):
+                data = struct.pack(">" + " BH L"[packet], len(frame)) + frame
+                self.assertRaises(EncodingError, TermStreamDecoder(packet=packet).feed, data)
+                self.assertRaises(EncodingError, TermStreamDecoder(packet=packet).feed_frames, data)
+
+    def testMailbox(self):
+        # Echo the terms back through a port stand-in
+        script = ("import erlastic\n"
+                  "mailbox, port = erlastic.port_connection()\n"
+                  "for term in mailbox: port.send(term)\n")
+        data = b"".join(self.frame(term, 4) for term in self.terms)
+        out = subprocess.run([sys.executable, "-c", script], input=data,
+                             stdout=subprocess.PIPE, check=True).stdout
+        self.assertEqual(TermStreamDecoder(packet=4).feed(out), self.terms)
+
+class TermFileTestCase(unittest.TestCase):
+    terms = StreamTestCase.terms
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "terms.etf")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def testReadWrite(self):
+        for packet in (0, 2, 4):
+            with TermFileWriter(self.path, packet=packet, buffer_size=100) as writer:
+                writer.extend(self.terms)
+            with TermFileReader(self.path, packet=packet) as reader:
+                self.assertEqual(len(reader), len(self.terms))
+                self.assertEqual(list(reader), self.terms)
+                self.assertEqual(reader[-1], self.terms[-1])
+                self.assertEqual(reader[2:10:3], self.terms[2:10:3])
+                self.assertEqual(reader.lazy(-1)[0], self.terms[-1][0])
+                self.assertEqual(bytes(reader.frame(0)), encode(self.terms[0]))
+                self.assertRaises(IndexError, reader.__getitem__, len(self.terms))
+            os.remove(self.path)
+            os.remove(self.path + ".idx")
+
+    def testIndex(self):
+        with TermFileWriter(self.path) as writer:
+            writer.extend(self.terms[:5])
+        with TermFileReader(self.path) as reader:
+            self.assertEqual(reader.saved, 6)
+        # Terms appended without the index, and an incomplete one
+        with open(self.path, "ab") as f:
+            for term in self.terms[5:8]:
+                f.write(struct.pack(">L", len(encode(term))) + encode(term))
+            f.write(struct.pack(">L", 100) + b"\x83")
+        with TermFileReader(self.path) as reader:
+            self.assertEqual(reader.saved, 6)
+            self.assertEqual(reader[:], self.terms[:8])
+        with TermFileWriter(self.path) as writer:
+            writer.append(self.terms[8])
+        with TermFileReader(self.path) as reader:
+            self.assertEqual(reader.saved, 10)
+            self.assertEqual(reader[:], self.terms[:9])
+        # An index of another file is rebuilt
+        with open(self.path, "wb") as f:
+            f.write(struct.pack(">L", 3) + encode(1))
+        with TermFileReader(self.path) as reader:
+            self.assertEqual(reader.saved, 0)
+            self.assertEqual(reader[:], [1])
+
+    def testRewrittenFile(self):
+        for packet in (0, 4):
+            terms = [(i, b"x" * i) for i in range(10)]
+            with TermFileWriter(self.path, packet=packet) as writer:
+                writer.extend(terms)
+            TermFileReader(self.path, packet=packet).close()
+            size = os.path.getsize(self.path)
+            # Rewritten with other terms, as large or larger, starting with
+            # the same one or not
+            for rewrite in ([(i, b"y" * (i + 1)) for i in range(10)],
+                            [terms[0]] + [(i, b"y" * (12 - i)) for i in range(1, 12)]):
+                with open(self.path, "wb") as f:
+                    for term in rewrite:
+                        f.write(struct.pack(">L", len(encode(term)))[4 - packet:] + encode(term))
+                self.assertGreaterEqual(os.path.getsize(self.path), size)
+                with TermFileReader(self.path, packet=packet) as reader:
+                    self.assertEqual(reader.saved, 0)
+                    self.assertEqual(reader[:], rewrite)
+                with TermFileReader(self.path, packet=packet) as reader:
+                    self.assertEqual(reader.saved, len(rewrite) + 1)
+            os.remove(self.path)
+            os.remove(self.path + ".idx")
+
+    def testUnwritableIndex(self):
+        with TermFileWriter(self.path, index=False) as writer:
+            writer.extend(self.terms)
+        # As in a read-only directory
+        index = os.path.join(self.dir.name, "missing", "terms.etf.idx")
+        with TermFileReader(self.path, index=index) as reader:
+            self.assertEqual(reader[:], self.terms)
+        self.assertFalse(os.path.exists(index))
+        # Indexes are rewritten through a temporary file
+        with TermFileReader(self.path) as reader:
+            self.assertEqual(reader.saved, 0)
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["terms.etf", "terms.etf.idx"])
+
+    def testMap(self):
+        with TermFileWriter(self.path) as writer:
+            writer.extend(self.terms)
+        with TermFileReader(self.path) as reader:
+            for executor in ("thread", "process"):
+                self.assertEqual(list(reader.map(repr, executor=executor, workers=2, chunk_size=3)),
+                                 [repr(term) for term in self.terms])
+            self.assertEqual(list(reader.map(repr, 2, 5, executor="thread")),
+                             [repr(term) for term in self.terms[2:5]])
+
+class AsyncPortTestCase(unittest.TestCase):
+    terms = StreamTestCase.terms
+
+    def testPortConnection(self):
+        # The test plays the Erlang side of an echo port
+        script = ("import asyncio, erlastic.aio\n"
+                  "async def main():\n"
+                  "    port = await erlastic.aio.port_connection()\n"
+                  "    async for term in port: await port.send(term)\n"
+                  "asyncio.run(main())\n")
+        data = b"".join(struct.pack(">L", len(encode(term))) + encode(term) for term in self.terms)
+        out = subprocess.run([sys.executable, "-c", script], input=data,
+                             stdout=subprocess.PIPE, check=True).stdout
+        self.assertEqual(TermStreamDecoder(packet=4).feed(out), self.terms)
+
+    def testBatchedSend(self):
+        async def main():
+            left, right = socket.socketpair()
+            sender = AsyncPortConnection(*await asyncio.open_connection(sock=left), packet=2)
+            receiver = AsyncPortConnection(*await asyncio.open_connection(sock=right), packet=2)
+            writes = []
+            write = sender.writer.write
+            sender.writer.write = lambda data: (writes.append(len(data)), write(data))
+            await asyncio.gather(*[sender.send(term) for term in self.terms[:10]])
+            self.assertEqual(len(writes), 1)
+            with self.assertRaises(ValueError):
+                await sender.send(b"x" * 70000)
+            await sender.send(Atom("done"))
+            await sender.close()
+            received = [term async for term in receiver]
+            await receiver.close()
+            return received
+        self.assertEqual(asyncio.run(main()), self.terms[:10] + [Atom("done")])
+
+class PortServerTestCase(unittest.TestCase):
+    script = ("import operator, sys, time\n"
+              "from erlastic.server import PortServer\n"
+              "def handler(request):\n"
+              "    ref, delay, value = request\n"
+              "    time.sleep(delay / 1000)\n"
+              "    return 1 // value\n"
+              "executor, tagged = sys.argv[1], sys.argv[2] == 'tagged'\n"
+              "server = PortServer(handler, executor, workers=4, max_in_flight=6,\n"
+              "                    tag=operator.itemgetter(0) if tagged else None)\n"
+              "server.serve()\n"
+              "sys.stderr.write(repr(server.stats))\n")
+
+    requests = [(i, 50 - 5 * i, 1 if i != 3 else 0) for i in range(10)]
+
+    def serve(self, executor, mode):
+        data = b"".join(struct.pack(">L", len(encode(term))) + encode(term) for term in self.requests)
+        result = subprocess.run([sys.executable, "-c", self.script, executor, mode], input=data,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        stats = result.stderr.decode()
+        self.assertTrue("errors=1" in stats and "replied=10" in stats and "queue_depth=0" in stats, stats)
+        return TermStreamDecoder(packet=4).feed(result.stdout)
+
+    def expected(self):
+        return [(Atom("error"), "ZeroDivisionError('integer division or modulo by zero')".encode())
+                if value == 0 else 1 for ref, delay, value in self.requests]
+
+    def testOrdered(self):
+        for executor in ("thread", "process"):
+            self.assertEqual(self.serve(executor, "ordered"), self.expected())
+
+    def testTagged(self):
+        for executor in ("thread", "process"):
+            replies = self.serve(executor, "tagged")
+            self.assertEqual(sorted(replies, key=repr), sorted(enumerate(self.expected()), key=repr))
+
+    def testUntagged(self):
+        frames = [encode((1, 2)), b"\x83\x01", encode(3), encode((4, 5))]
+        port = ListPort()
+        server = PortServer(lambda request: request[1], "thread", workers=1,
+                            tag=lambda request: request[0], mailbox=iter(frames), port=port)
+        server.serve()
+        self.assertEqual(sorted(port.sent[i] for i in (0, 3)), [(1, 2), (4, 5)])
+        self.assertEqual([reply[0] for reply in port.sent[1:3]], [Atom("error")] * 2)
+        self.assertEqual(server.stats.errors, 2)
+
+    def testBrokenPort(self):
+        for tag in (None, operator.itemgetter(0)):
+            port = ListPort(fail=True)
+            server = PortServer(lambda request: request, "thread", workers=2, max_in_flight=2,
+                                tag=tag, mailbox=iter([encode((i,)) for i in range(10)]), port=port)
+            # Doesn't block for a slot once the replies fail to be sent
+            server.serve()
+            self.assertEqual(port.attempts, 10)
+            self.assertEqual((server.stats.received, server.stats.replied, server.stats.queue_depth), (10, 0, 0))
+
+class ListPort(object):
+    """Collects the replies sent, or fails to send any"""
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sent = []
+        self.attempts = 0
+    def send(self, frame):
+        self.attempts += 1
+        if self.fail:
+            raise BrokenPipeError(32, "Broken pipe")
+        self.sent.append(decode(frame))
+
+class ShortWriteSocket(object):
+    """Sends at most 3 bytes per call"""
+    def __init__(self):
+        self.data = bytearray()
+    def sendmsg(self, buffers):
+        data = b"".join(bytes(buf) for buf in buffers)[:3]
+        self.data += data
+        return len(data)
+
+class TcpTestCase(unittest.TestCase):
+    terms = StreamTestCase.terms
+
+    def serve(self, handler, packet=4):
+        server = TermServer(handler, packet=packet)
+        server.start()
+        self.addCleanup(server.close)
+        return server
+
+    def testCall(self):
+        for packet in (0, 1, 2, 4):
+            terms = [term for term in self.terms if len(encode(term)) < 1 << (8 * packet) or not packet]
+            server = self.serve(lambda request: (Atom("ok"), request), packet)
+            with TermClient(server.address, packet=packet, size=2) as client:
+                for term in terms:
+                    self.assertEqual(client.call(term), (Atom("ok"), term))
+                self.assertEqual(client.call_many(terms), [(Atom("ok"), term) for term in terms])
+                self.assertEqual(client.idle.qsize(), 1)
+            self.assertEqual(call(server.address, 1, packet), (Atom("ok"), 1))
+
+    def testLargeTerm(self):
+        server = self.serve(len)
+        with TermClient(server.address) as client:
+            self.assertEqual(client.call(b"x" * 1000000), 1000000)
+
+    def testErrors(self):
+        server = self.serve(lambda request: 1 // request)
+        with TermClient(server.address, size=1) as client:
+            self.assertEqual(client.call(0), (Atom("error"), b"ZeroDivisionError('integer division or modulo by zero')"))
+            self.assertEqual(client.call(1), 1)
+            connection = client.idle.get()
+            connection.socket.close()
+            client.idle.put(connection)
+            # The broken connection is dropped
+            self.assertRaises(OSError, client.call, 1)
+            self.assertEqual(client.idle.qsize(), 0)
+            self.assertEqual(client.call(1), 1)
+
+    def testMalformedRequest(self):
+        server = self.serve(lambda request: request)
+        with connect(server.address) as connection:
+            connection.socket.sendall(b"\x00\x00\x00\x02\x83\x01" + struct.pack(">L", 3) + encode(1))
+            reply = connection.recv()
+            self.assertEqual(reply[0], Atom("error"))
+            self.assertTrue(reply[1].startswith(b"KeyError"), reply)
+            # The connection is still usable
+            self.assertEqual(connection.recv(), 1)
+            connection.send(2)
+            self.assertEqual(connection.recv(), 2)
+
+    def testConcurrentCalls(self):
+        server = self.serve(lambda request: -request)
+        results = {}
+        with TermClient(server.address, size=3) as client:
+            def run(i):
+                results[i] = client.call_many(list(range(i, i + 50)))
+            threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertLessEqual(client.idle.qsize(), 3)
+        self.assertEqual(results, dict((i, [-j for j in range(i, i + 50)]) for i in range(8)))
+
+    def testSendFrames(self):
+        server = self.serve(lambda request: request)
+        with connect(server.address) as connection:
+            connection.send_frames([encode(term) for term in self.terms])
+            self.assertEqual([connection.recv() for term in self.terms], self.terms)
+        server.close()
+        self.assertRaises(OSError, call, server.address, 1)
+
+    def testShortWrites(self):
+        sock = ShortWriteSocket()
+        buffers = [b"abcd", b"", b"e", bytearray(b"fghijkl"), memoryview(b"mn")]
+        sendmsg_all(sock, buffers)
+        self.assertEqual(sock.data, b"abcdefghijklmn")
+
 if __name__ == '__main__':
     unittest.main()